@@ -0,0 +1,242 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import csv
+import datetime
+import glob
+import multiprocessing
+import os
+import queue
+import time
+import cv2
+import numpy as np
+
+from sort.sort import Sort
+from sort.batch import BatchSort
+from tracker.tracker import ObjectCounter
+from calibration.calibration import create_calibration
+from reporter.reporter import field_names, format_record
+from detector.detector import create_detector
+from motion.motion import MotionGate
+from utils.utils import media_timestamp
+
+# Video file extensions searched for when a directory is given.
+video_extensions = (".mp4", ".avi", ".mkv", ".mov")
+
+# Columns of the merged report. The provenance of each record goes first.
+batch_field_names = ["source", "frame"] + field_names
+
+# Frames between two progress messages of a worker.
+progress_interval = 500
+
+# Index of the worker inside the pool, assigned when the worker process starts.
+worker_index = 0
+
+# Detector of the worker, loaded once when the worker process starts and used for all its files,
+# or the error that prevented loading it.
+worker_detector = None
+worker_error = None
+
+def find_videos(inputs):
+	"""
+	Expands a list of files, directories and glob patterns into a sorted list of video files.
+	"""
+	videos = set()
+	for item in inputs:
+		if os.path.isdir(item):
+			for name in os.listdir(item):
+				if name.lower().endswith(video_extensions):
+					videos.add(os.path.join(item, name))
+		else:
+			videos.update(path for path in glob.glob(item) if os.path.isfile(path))
+	return sorted(videos)
+
+
+def default_workers(config):
+	"""
+	Returns the number of workers to use by default: one per Edge TPU with the edgetpu backend, as each one can
+	only be used by one process, or one per CPU core with the other backends.
+	"""
+	if config["detector"]["backend"] == "edgetpu":
+		from pycoral.utils.edgetpu import list_edge_tpus
+		return len(list_edge_tpus())
+	return os.cpu_count() or 1
+
+
+def init_worker(worker_ids, config):
+	"""
+	Gives each worker process its own index, used to pick its Edge TPU device, and loads its detector.
+	"""
+	global worker_index, worker_detector, worker_error
+	worker_index = worker_ids.get()
+	# A worker that cannot load its detector fails its files instead of stopping the pool.
+	try:
+		worker_detector = create_detector(config, ":" + str(worker_index))
+	except Exception as e:
+		worker_error = e
+
+
+def process_video(job):
+	"""
+	Processes a whole video file with the detector of the worker and its own tracker and counter. Returns the path, the records found,
+	the number of frames, the processing time and the error that stopped it, if any. An error only fails its own
+	file, so the records of the other files are still merged.
+	"""
+	path, config, progress = job
+	try:
+		if worker_error is not None:
+			raise RuntimeError("The detector could not be loaded: %s" % worker_error)
+		return process_file(path, config, progress)
+	except Exception as e:
+		progress.put((worker_index, path, 0, 0.0, True))
+		print("[ERROR]   The video file could not be processed: %s: %s" % (path, e))
+		return path, [], 0, 0.0, str(e)
+
+
+def process_file(path, config, progress):
+	"""
+	Does the work of process_video for a single file.
+	"""
+
+	videoStream = cv2.VideoCapture(path)
+	if not videoStream.isOpened():
+		progress.put((worker_index, path, 0, 0.0, True))
+		print("[ERROR]   The video file could not be opened:", path)
+		return path, [], 0, 0.0, "The video file could not be opened."
+
+	# The recording is assumed to finish when the file was last modified, so its start time is found from its duration.
+	fps = videoStream.get(cv2.CAP_PROP_FPS)
+	duration = videoStream.get(cv2.CAP_PROP_FRAME_COUNT) / fps if fps > 0 else 0
+	start = datetime.datetime.fromtimestamp(os.path.getmtime(path)) - datetime.timedelta(seconds = duration)
+
+	# The tracker and the counter are built again for every file, as they keep the state of one video.
+	detector = worker_detector
+	tracker_backend = BatchSort if config["tracker"]["backend"] == "batch" else Sort
+	tracker = tracker_backend(max_age = config["tracker"]["max_age"], min_hits = config["tracker"]["min_hits"], iou_threshold = config["tracker"]["iou_threshold"])
+	counter = ObjectCounter(videoStream, config["tracker"]["history"], create_calibration(config))
+	motion_gate = None
+	if config["motion"]["enabled"]:
+		motion_gate = MotionGate(config["detector"]["regions"], config["motion"]["width"], config["motion"]["threshold"],
+			config["motion"]["min_area"], config["motion"]["hold_frames"])
+
+	records = []
+	frame_index = 0
+	processing_start = time.monotonic()
+
+	# The counter messages of several workers would be mixed up, so they are discarded.
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		while True:
+			ret, image = videoStream.read()
+			if not(ret):
+				break
+			frame_index += 1
+			timestamp = media_timestamp(videoStream, frame_index, start, fps)
+
+			# Static frames are not run through the detector.
+			if motion_gate is None or motion_gate.moving(image):
+				detections = detector.detect(image)
+				detections = detections[np.isin(detections[:, 5], config["detector"]["classes"])]
+			else:
+				detections = np.empty((0, 6))
+			trackers = tracker.update(detections)
+			for record in counter.update(trackers, False, frame_index, timestamp):
+				record["source"] = path
+				record["frame"] = frame_index
+				records.append(record)
+
+			if frame_index % progress_interval == 0:
+				progress.put((worker_index, path, frame_index, time.monotonic() - processing_start, False))
+
+		# The vehicles still in sight at the end of the video are reported too.
+		for record in counter.drain():
+			record["source"] = path
+			record["frame"] = frame_index
+			records.append(record)
+
+	videoStream.release()
+	elapsed = time.monotonic() - processing_start
+	progress.put((worker_index, path, frame_index, elapsed, True))
+	return path, records, frame_index, elapsed, None
+
+
+def run_batch(videos, config, workers, output, report_interval = 10):
+	"""
+	Spreads the videos across a pool of worker processes and merges their records into a single time-ordered report.
+	"""
+	manager = multiprocessing.Manager()
+	progress = manager.Queue()
+	worker_ids = manager.Queue()
+	for i in range(workers):
+		worker_ids.put(i)
+
+	# Frames processed and time spent by each worker on its current file, plus the frames of the files already finished.
+	current = {}
+	finished_frames = 0
+	files_done = 0
+	batch_start = time.monotonic()
+	last_report = batch_start
+
+	with multiprocessing.Pool(workers, initializer = init_worker, initargs = (worker_ids, config)) as pool:
+		result = pool.map_async(process_video, [(path, config, progress) for path in videos], chunksize = 1)
+
+		while not (result.ready() and progress.empty()):
+			try:
+				index, path, frames, elapsed, done = progress.get(timeout = 0.5)
+				if done:
+					finished_frames += frames
+					files_done += 1
+					current.pop(index, None)
+					print("[INFO]    Finished %s: %d frames in %.1f s (%.2f FPS)." % (path, frames, elapsed, frames / elapsed if elapsed > 0 else 0))
+				else:
+					current[index] = (path, frames, elapsed)
+			except queue.Empty:
+				pass
+
+			# Throughput of each worker and of the whole pool.
+			if time.monotonic() - last_report >= report_interval:
+				last_report = time.monotonic()
+				total_frames = finished_frames + sum(frames for path, frames, elapsed in current.values())
+				for index, (path, frames, elapsed) in sorted(current.items()):
+					print("[INFO]    Worker %d: %s, %d frames, %.2f FPS" % (index, os.path.basename(path), frames, frames / elapsed if elapsed > 0 else 0))
+				print("[INFO]    Progress: %d/%d files, %d frames, %.2f FPS total" % (files_done, len(videos), total_frames, total_frames / (last_report - batch_start)))
+
+		results = result.get()
+
+	# The records of all the files are merged and sorted by time.
+	records = [record for path, file_records, frames, elapsed, error in results for record in file_records]
+	records.sort(key = lambda record: record["timestamp"])
+	with open(output, 'w', newline='') as outcsv:
+		writer = csv.DictWriter(outcsv, fieldnames = batch_field_names)
+		writer.writeheader()
+		for record in records:
+			row = format_record(record)
+			row["source"] = record["source"]
+			row["frame"] = record["frame"]
+			writer.writerow(row)
+
+	total_frames = sum(frames for path, file_records, frames, elapsed, error in results)
+	total_time = time.monotonic() - batch_start
+	print("[INFO]    Processed %d files, %d frames in %.1f s (%.2f FPS total)." % (len(videos), total_frames, total_time, total_frames / total_time if total_time > 0 else 0))
+	print("[INFO]    %d records saved to: %s" % (len(records), output))
+	failed = [(path, error) for path, file_records, frames, elapsed, error in results if error is not None]
+	for path, error in failed:
+		print("[WARNING] Failed: %s: %s" % (path, error))
+	if failed:
+		print("[WARNING] %d of %d files could not be processed." % (len(failed), len(videos)))
+	return records
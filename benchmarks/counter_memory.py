@@ -0,0 +1,99 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+	Feeds a synthetic day of traffic through the ObjectCounter and checks that its memory stays flat. It exits
+	with code 1 if the memory grew more than the tolerance after the first hour. Run it from the repository root:
+
+		$ python3 -m benchmarks.counter_memory --hours 24 --fps 5
+"""
+
+import argparse
+import contextlib
+import datetime
+import os
+import sys
+import tracemalloc
+import numpy as np
+
+from tracker.tracker import ObjectCounter
+
+
+def synthetic_tracks(frames, fps, spawn_interval, speed):
+	"""
+	Yields, frame by frame, the tracker output for vehicles crossing the image in both directions.
+	"""
+	vehicles = {}
+	next_id = 1
+	for frame in range(1, frames + 1):
+		# A new vehicle enters the image every few frames, alternating the direction.
+		if frame % spawn_interval == 0:
+			direction = 1 if next_id % 2 else -1
+			vehicles[next_id] = [400.0 if direction == 1 else 1000.0, direction]
+			next_id += 1
+
+		rows = []
+		for vehicle_id, vehicle in list(vehicles.items()):
+			vehicle[0] += vehicle[1] * speed / fps
+			if vehicle[0] < 380 or vehicle[0] > 1020:
+				del vehicles[vehicle_id]
+				continue
+			rows.append([vehicle[0] - 40, 300, vehicle[0] + 40, 360, vehicle_id, 2])
+		yield frame, np.array(rows).reshape(-1, 6)
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "ObjectCounter memory check.")
+	parser.add_argument("--hours", type = float, default = 24, help = "Hours of synthetic traffic.")
+	parser.add_argument("--fps", type = int, default = 5, help = "Simulated frames per second.")
+	parser.add_argument("--spawn", type = int, default = 10, help = "Frames between two vehicles.")
+	parser.add_argument("--speed", type = float, default = 150, help = "Vehicle speed in pixels per second.")
+	parser.add_argument("--tolerance", type = int, default = 64 * 1024, help = "Allowed memory growth in bytes.")
+	args = parser.parse_args()
+	if args.hours <= 1:
+		parser.error("--hours must be more than 1, as the first hour is taken as the baseline.")
+
+	frames = int(args.hours * 3600 * args.fps)
+	checkpoint = 3600 * args.fps
+	counter = ObjectCounter(None)
+	samples = []
+	start = datetime.datetime(2021, 1, 1)
+
+	tracemalloc.start()
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		for frame, tracks in synthetic_tracks(frames, args.fps, args.spawn, args.speed):
+			counter.update(tracks, False, frame, start + datetime.timedelta(seconds = frame / args.fps))
+			if frame % checkpoint == 0:
+				samples.append((frame / checkpoint, tracemalloc.get_traced_memory()[0], len(counter.objects)))
+		# The end of a run that does not last a whole number of hours is sampled too.
+		if frames % checkpoint:
+			samples.append((frames / checkpoint, tracemalloc.get_traced_memory()[0], len(counter.objects)))
+	tracemalloc.stop()
+
+	for hour, memory, objects in samples:
+		print("[INFO]    Hour %5.1f: %8d bytes traced, %3d tracked objects" % (hour, memory, objects))
+
+	# The first hour is taken as the baseline, once all the caches have been warmed up.
+	growth = samples[-1][1] - samples[0][1]
+	print("[INFO]    Memory growth after the first hour:", growth, "bytes")
+	if growth > args.tolerance:
+		print("[ERROR]   Memory is not flat.")
+		sys.exit(1)
+	print("[INFO]    Memory is flat.")
+
+
+if __name__ == '__main__':
+	main()
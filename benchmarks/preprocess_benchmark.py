@@ -0,0 +1,126 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+	Measures the time and the memory allocated per frame to get a frame into the input tensor of the model,
+	comparing the previous preprocessing (resize into a new array, then copy it into the tensor) with the
+	current one (resize and colour conversion straight into the tensor). Run it from the repository root:
+
+		$ python3 -m benchmarks.preprocess_benchmark
+		$ python3 -m benchmarks.preprocess_benchmark --model ./models/tflite/ssd_mobilenet_v2_coco_quant_postprocess.tflite
+"""
+
+import argparse
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from detector.detector import Detector
+
+
+class ArrayInterpreter(object):
+	"""
+	Keeps an input tensor in an array, as the interpreter does, so the preprocessing can be measured without a model.
+	"""
+	def __init__(self, width, height, dtype):
+		self.dtype = dtype
+		self.data = np.zeros((1, height, width, 3), dtype)
+
+	def get_input_details(self):
+		return [{'index': 0, 'dtype': self.dtype, 'shape': np.array(self.data.shape)}]
+
+	def tensor(self, index):
+		return lambda: self.data
+
+	def set_tensor(self, index, value):
+		self.data[...] = value
+
+
+def make_detector(args, dtype):
+	"""
+	Returns a detector whose input tensor belongs to the given model, or to an array of the given size if there is none.
+	"""
+	detector = Detector(0.5)
+	if args.model:
+		try:
+			from tflite_runtime.interpreter import Interpreter
+		except ImportError:
+			from tensorflow.lite import Interpreter
+		detector.interpreter = Interpreter(model_path = args.model)
+		detector.interpreter.allocate_tensors()
+	else:
+		detector.interpreter = ArrayInterpreter(args.size, args.size, dtype)
+	detector.prepare_input()
+	return detector
+
+
+def previous_set_input(detector, image):
+	"""
+	The preprocessing as it used to be done: the resized frame and the normalized one were new arrays, copied into the tensor.
+	"""
+	new_frame = cv2.resize(image, (detector.model_height, detector.model_width), interpolation = cv2.INTER_AREA)
+	if detector.input_dtype == np.uint8:
+		input_tensor = new_frame[np.newaxis]
+	else:
+		input_tensor = ((new_frame.astype(np.float32) - 127.5) / 127.5)[np.newaxis]
+	detector.interpreter.set_tensor(detector.input_index, input_tensor)
+
+
+def measure(function, detector, image, frames):
+	"""
+	Returns the median time and the mean of the memory allocated per frame.
+	"""
+	latencies = np.empty(frames)
+	for i in range(frames):
+		start = time.perf_counter()
+		function(detector, image)
+		latencies[i] = time.perf_counter() - start
+
+	allocations = np.empty(frames)
+	tracemalloc.start()
+	for i in range(frames):
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		function(detector, image)
+		allocations[i] = tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	return float(np.median(latencies)) * 1e6, int(allocations.mean())
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Preprocessing benchmark.")
+	parser.add_argument("--model", default = None, help = "TensorFlow Lite model to take the input tensor from. Not compiled for the Edge TPU.")
+	parser.add_argument("--size", type = int, default = 300, help = "Input size of the model, used when no model is given.")
+	parser.add_argument("--resolutions", nargs = "+", default = ["1280x720", "1920x1080"], help = "Frame sizes to measure, as WIDTHxHEIGHT.")
+	parser.add_argument("--frames", type = int, default = 200, help = "Frames of each run.")
+	args = parser.parse_args()
+
+	dtypes = [None] if args.model else [np.uint8, np.float32]
+	for dtype in dtypes:
+		detector = make_detector(args, dtype)
+		for resolution in args.resolutions:
+			width, height = (int(v) for v in resolution.split("x"))
+			image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype = np.uint8)
+			for name, function in (("previous", previous_set_input), ("current", Detector.set_input)):
+				latency, allocated = measure(function, detector, image, args.frames)
+				print("[INFO]    %-7s input, %9s frames, %-8s: %8.1f us, %9d bytes/frame" % (np.dtype(detector.input_dtype).name,
+					resolution, name, latency, allocated))
+
+
+if __name__ == '__main__':
+	main()
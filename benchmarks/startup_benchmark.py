@@ -0,0 +1,114 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+	Measures how long the process takes to start. Run it from the repository root:
+
+		$ python3 -m benchmarks.startup_benchmark
+		$ python3 -m benchmarks.startup_benchmark --config ./config.yml
+"""
+
+import argparse
+import concurrent.futures
+import json
+import statistics
+import subprocess
+import sys
+import time
+import cv2
+import yaml
+
+# Modules imported by the main loop.
+project_modules = ["sort.sort", "sort.batch", "tracker.tracker", "detector.detector", "reporter.reporter", "reporter.database",
+	"mqtt.mqtt", "pipeline.pipeline", "metrics.metrics", "utils.utils"]
+
+# Heavy modules that the tracking stack used to import when it was loaded.
+heavy_modules = ["matplotlib.pyplot", "skimage.io", "filterpy.kalman", "scipy.optimize"]
+
+# Runs in a new interpreter, so nothing is imported beforehand.
+import_script = """
+import json, sys, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+	__import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": sorted(m for m in sys.modules if m.split('.')[0] in ("matplotlib", "skimage", "filterpy", "scipy"))}))
+"""
+
+
+def import_time(modules, repeat):
+	"""
+	Returns the median time needed to import some modules in a new process, and the heavy modules they loaded.
+	"""
+	samples = []
+	loaded = []
+	for i in range(repeat):
+		output = subprocess.run([sys.executable, "-c", import_script] + modules, capture_output = True, text = True)
+		if output.returncode != 0:
+			return None, output.stderr.strip().splitlines()[-1]
+		result = json.loads(output.stdout)
+		samples.append(result["seconds"])
+		loaded = result["loaded"]
+	return statistics.median(samples), loaded
+
+
+def startup_time(config):
+	"""
+	Returns how long loading the model and opening the video stream take, one after the other and at the same time.
+	"""
+	from detector.detector import create_detector
+
+	start = time.perf_counter()
+	create_detector(config)
+	cv2.VideoCapture(config["input"]["source"]).release()
+	sequential = time.perf_counter() - start
+
+	start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+		stream_future = executor.submit(cv2.VideoCapture, config["input"]["source"])
+		create_detector(config)
+		stream_future.result().release()
+	parallel = time.perf_counter() - start
+	return sequential, parallel
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Startup time benchmark.")
+	parser.add_argument("--repeat", type = int, default = 5, help = "Times each measure is repeated.")
+	parser.add_argument("--config", default = None, help = "Configuration file. If given, loading the model and opening the stream are measured too.")
+	args = parser.parse_args()
+
+	seconds, loaded = import_time(project_modules, args.repeat)
+	if seconds is None:
+		print("[ERROR]   The project modules could not be imported:", loaded)
+	else:
+		print("[INFO]    Project modules imported in %.3f s. Heavy modules loaded: %s" % (seconds, ", ".join(loaded) or "none"))
+
+	# What the tracking stack would cost if it still imported the visualisation and filtering packages.
+	seconds, loaded = import_time(heavy_modules, args.repeat)
+	if seconds is None:
+		print("[WARNING] The heavy modules could not be imported:", loaded)
+	else:
+		print("[INFO]    Heavy modules (%s) imported in %.3f s." % (", ".join(heavy_modules), seconds))
+
+	if args.config:
+		config = yaml.safe_load(open(args.config))
+		sequential, parallel = startup_time(config)
+		print("[INFO]    Model loading and stream opening: %.3f s one after the other, %.3f s at the same time." % (sequential, parallel))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,96 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+class SyntheticTraffic(object):
+	"""
+	This class generates vehicles driving across the image in both directions, without a camera or a detector.
+	The number of vehicles in the image stays constant: each one that leaves is replaced by a new one.
+	"""
+	def __init__(self, objects, speed = 5.0, occlusion = 0.0, noise = 0.0, width = 1280, height = 720, seed = 0):
+		self.objects = objects
+		self.speed = speed
+		self.occlusion = occlusion
+		self.noise = noise
+		self.width = width
+		self.height = height
+		self.rng = np.random.default_rng(seed)
+		self.next_id = 1
+
+		# Centre, velocity, size and identity of every vehicle.
+		self.position = np.empty((objects, 2))
+		self.velocity = np.empty(objects)
+		self.size = np.empty((objects, 2))
+		self.ids = np.empty(objects, dtype = int)
+		self.classes = np.empty(objects)
+		self.spawn(np.arange(objects), initial = True)
+
+
+	def spawn(self, indexes, initial = False):
+		"""
+		Places new vehicles at the edge of the image, or anywhere along the road at the start.
+		"""
+		n = len(indexes)
+		direction = self.rng.choice((-1.0, 1.0), n)
+		self.velocity[indexes] = direction * self.speed * self.rng.uniform(0.7, 1.3, n)
+		self.size[indexes] = np.stack((self.rng.uniform(60, 120, n), self.rng.uniform(40, 70, n)), axis = 1)
+		if initial:
+			self.position[indexes, 0] = self.rng.uniform(0, self.width, n)
+		else:
+			self.position[indexes, 0] = np.where(direction > 0, 0.0, self.width)
+		self.position[indexes, 1] = self.rng.uniform(0.2 * self.height, 0.8 * self.height, n)
+		self.ids[indexes] = np.arange(self.next_id, self.next_id + n)
+		self.classes[indexes] = self.rng.choice((2.0, 7.0), n, p = (0.9, 0.1))
+		self.next_id += n
+
+
+	def boxes(self):
+		"""
+		Returns the true [x1, y1, x2, y2] box of every vehicle.
+		"""
+		half = self.size / 2
+		return np.concatenate((self.position - half, self.position + half), axis = 1)
+
+
+	def step(self):
+		"""
+		Moves the vehicles one frame forward. Returns the detections, as [x1, y1, x2, y2, score, class],
+		and the true tracks, as [x1, y1, x2, y2, id, class], in the formats used by the tracker and the counter.
+		"""
+		self.position[:, 0] += self.velocity
+		gone = np.flatnonzero((self.position[:, 0] < 0) | (self.position[:, 0] > self.width))
+		if len(gone):
+			self.spawn(gone)
+
+		boxes = self.boxes()
+		tracks = np.concatenate((boxes, self.ids[:, None], self.classes[:, None]), axis = 1)
+
+		# Occluded vehicles are not detected, and the boxes of the others are moved around by the noise.
+		visible = self.rng.random(self.objects) >= self.occlusion
+		noisy = boxes[visible] + self.rng.normal(0, self.noise, (int(visible.sum()), 4))
+		scores = self.rng.uniform(0.5, 1.0, len(noisy))
+		detections = np.concatenate((noisy, scores[:, None], self.classes[visible, None]), axis = 1)
+		return detections, tracks
+
+
+	def frames(self, count):
+		"""
+		Generates a number of frames ahead of time, so generating them is not measured.
+		"""
+		return [self.step() for frame in range(count)]
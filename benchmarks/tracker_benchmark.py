@@ -0,0 +1,191 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+	Measures the per-frame latency and memory allocations of the tracker and counter hot paths
+	with synthetic traffic. Run it from the repository root:
+
+		$ python3 -m benchmarks.tracker_benchmark --output results.json
+		$ python3 -m benchmarks.tracker_benchmark --compare results.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+
+from benchmarks.synthetic import SyntheticTraffic
+from sort.sort import Sort, KalmanBoxTracker, associate_detections_to_trackers, iou_batch
+from sort.batch import BatchSort
+from tracker.tracker import ObjectCounter
+
+start_time = datetime.datetime(2021, 1, 1)
+
+
+def make_targets(args):
+	"""
+	Returns the functions to measure. Each one takes the frames and returns a callable for a single frame.
+	"""
+	def sort_reference(frames):
+		tracker = Sort(args.max_age, args.min_hits, args.iou_threshold)
+		return lambda frame: tracker.update(frame[0])
+
+	def sort_batch(frames):
+		tracker = BatchSort(args.max_age, args.min_hits, args.iou_threshold)
+		return lambda frame: tracker.update(frame[0])
+
+	def iou(frames):
+		return lambda frame: iou_batch(frame[0], frame[1])
+
+	def association(frames):
+		return lambda frame: associate_detections_to_trackers(frame[0], frame[1], args.iou_threshold)
+
+	def counter(frames):
+		counter = ObjectCounter(None)
+		index = [0]
+		def update(frame):
+			index[0] += 1
+			return counter.update(frame[1], False, index[0], start_time + datetime.timedelta(seconds = index[0] / args.fps))
+		return update
+
+	return {
+		"Sort.update": sort_reference,
+		"BatchSort.update": sort_batch,
+		"iou_batch": iou,
+		"associate_detections_to_trackers": association,
+		"ObjectCounter.update": counter,
+	}
+
+
+def measure(name, target, frames, warmup):
+	"""
+	Runs a target over all the frames twice: once timing each frame and once tracing its memory allocations.
+	"""
+	KalmanBoxTracker.count = 0
+	update = target(frames)
+	latencies = np.empty(len(frames))
+	for i, frame in enumerate(frames):
+		start = time.perf_counter()
+		update(frame)
+		latencies[i] = time.perf_counter() - start
+	latencies = latencies[warmup:] * 1e6
+
+	# Peak of the memory allocated while processing each frame.
+	KalmanBoxTracker.count = 0
+	update = target(frames)
+	allocations = np.empty(len(frames))
+	tracemalloc.start()
+	for i, frame in enumerate(frames):
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		update(frame)
+		allocations[i] = tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	allocations = allocations[warmup:]
+
+	return {
+		"target": name,
+		"p50_us": round(float(np.percentile(latencies, 50)), 2),
+		"p99_us": round(float(np.percentile(latencies, 99)), 2),
+		"mean_us": round(float(latencies.mean()), 2),
+		"alloc_mean_bytes": int(allocations.mean()),
+		"alloc_max_bytes": int(allocations.max()),
+	}
+
+
+def git_version():
+	"""
+	Returns the current commit, so results of different versions can be told apart.
+	"""
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr = subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+
+def compare(results, baseline_path):
+	"""
+	Prints the change of the p50 and p99 latencies against a previous run.
+	"""
+	with open(baseline_path) as f:
+		baseline = {(r["target"], r["objects"]): r for r in json.load(f)["results"]}
+	print("[INFO]    Comparison against", baseline_path)
+	for result in results:
+		previous = baseline.get((result["target"], result["objects"]))
+		if previous is None:
+			continue
+		print("[INFO]    %-34s %4d objects: p50 %+7.1f%%, p99 %+7.1f%%" % (result["target"], result["objects"],
+			100 * (result["p50_us"] / previous["p50_us"] - 1), 100 * (result["p99_us"] / previous["p99_us"] - 1)))
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Tracker and counter benchmark with synthetic traffic.")
+	parser.add_argument("--objects", type = int, nargs = "+", default = [1, 10, 50, 200], help = "Concurrent vehicles of each run.")
+	parser.add_argument("--frames", type = int, default = 1000, help = "Frames of each run.")
+	parser.add_argument("--warmup", type = int, default = 50, help = "Frames left out of the statistics.")
+	parser.add_argument("--speed", type = float, default = 5.0, help = "Vehicle speed in pixels per frame.")
+	parser.add_argument("--occlusion", type = float, default = 0.05, help = "Probability of missing a vehicle in a frame.")
+	parser.add_argument("--noise", type = float, default = 2.0, help = "Standard deviation of the detection boxes, in pixels.")
+	parser.add_argument("--fps", type = float, default = 25.0, help = "Frame rate used for the counter timestamps.")
+	parser.add_argument("--max-age", type = int, default = 3)
+	parser.add_argument("--min-hits", type = int, default = 5)
+	parser.add_argument("--iou-threshold", type = float, default = 0.3)
+	parser.add_argument("--targets", nargs = "+", default = None, help = "Only measure these functions.")
+	parser.add_argument("--output", default = None, help = "JSON file to save the results to.")
+	parser.add_argument("--compare", default = None, help = "JSON file of a previous run to compare against.")
+	args = parser.parse_args()
+
+	targets = make_targets(args)
+	if args.targets:
+		targets = {name: target for name, target in targets.items() if name in args.targets}
+
+	results = []
+	with open(os.devnull, "w") as devnull:
+		for objects in args.objects:
+			frames = SyntheticTraffic(objects, args.speed, args.occlusion, args.noise).frames(args.frames)
+			for name, target in targets.items():
+				# The counter prints every vehicle, which is not part of what is measured.
+				with contextlib.redirect_stdout(devnull):
+					result = measure(name, target, frames, args.warmup)
+				result["objects"] = objects
+				results.append(result)
+				print("[INFO]    %-34s %4d objects: p50 %9.1f us, p99 %9.1f us, %9d bytes/frame" % (name, objects, result["p50_us"], result["p99_us"], result["alloc_mean_bytes"]))
+
+	report = {
+		"version": git_version(),
+		"date": datetime.datetime.now().isoformat(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"machine": platform.machine(),
+		"parameters": vars(args),
+		"results": results,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent = 2)
+		print("[INFO]    Results saved to:", args.output)
+	if args.compare:
+		compare(results, args.compare)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,66 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cv2
+import numpy as np
+
+# Calibration used when none is given: 0.0087 metres per pixel, with the reference lines at x = 590, 670, 740 and 790 pixels.
+default_image_points = [[0, 0], [1280, 0], [1280, 720], [0, 720]]
+default_world_points = [[0, 0], [11.136, 0], [11.136, 6.264], [0, 6.264]]
+default_lines = [5.133, 5.829, 6.438, 6.873]
+
+class Calibration(object):
+	"""
+	This class maps image pixels to positions on the ground plane through a homography, found from four or more
+	points whose position on the road is known. The x axis of the world must run along the road, as the reference
+	lines used to measure the speed are given as distances along it.
+	"""
+	def __init__(self, image_points, world_points, lines):
+		image_points = np.asarray(image_points, dtype = np.float64).reshape(-1, 2)
+		world_points = np.asarray(world_points, dtype = np.float64).reshape(-1, 2)
+		if len(image_points) < 4 or len(image_points) != len(world_points):
+			raise ValueError("The calibration needs at least four pairs of image and world points.")
+		if len(lines) < 2:
+			raise ValueError("The calibration needs at least two reference lines.")
+
+		# With more than four points, the homography is fitted by least squares over all of them.
+		self.homography, _ = cv2.findHomography(image_points, world_points)
+		if self.homography is None:
+			raise ValueError("The calibration points do not define a homography. Three of them may be on the same line.")
+		self.lines = tuple(sorted(float(line) for line in lines))
+
+		# How far the image points land from their world position, a hint of how good the calibration is.
+		self.error = float(np.sqrt(np.mean(np.sum((self.to_world(image_points) - world_points) ** 2, axis = 1))))
+
+
+	def to_world(self, points):
+		"""
+		Converts an array of [x, y] pixels into [x, y] positions on the road, in metres, all at once.
+		"""
+		points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+		projected = points @ self.homography[:, :2].T + self.homography[:, 2]
+		return projected[:, :2] / projected[:, 2:]
+
+
+def create_calibration(config):
+	"""
+	Instantiates the calibration given in the configuration file.
+	"""
+	calibration = Calibration(config["calibration"]["image_points"], config["calibration"]["world_points"], config["calibration"]["lines"])
+	print("[INFO]    Calibration error: %.3f m." % (calibration.error))
+	return calibration
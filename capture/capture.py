@@ -0,0 +1,133 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import os
+import threading
+
+from utils.utils import open_stream
+
+# Seconds the reader waits for a frame before checking again if it has to stop.
+poll_interval = 0.1
+
+class LiveStream(threading.Thread):
+	"""
+	This class reads a live video stream on its own thread, as fast as the camera sends the frames, and keeps only
+	the newest one. If the processing is slower than the camera, the frames in between are dropped instead of piling
+	up in the decoder's buffer, so the counts never fall behind reality. If the stream is lost, it is opened again,
+	waiting longer after each failed attempt. The end of a video file is the end of the stream, it is not reopened.
+	"""
+	def __init__(self, video_stream, source, width = 0, height = 0, reconnect = True, max_delay = 60.0):
+		super().__init__(name = "reader", daemon = True)
+		self.video_stream = video_stream
+		self.source = source
+		self.width = width
+		self.height = height
+		self.reconnect = reconnect and not os.path.isfile(str(source))
+		self.max_delay = max_delay
+		self.delay = 1.0
+		self.condition = threading.Condition()
+		self.stop_event = threading.Event()
+		self.frame = None
+		self.frames = 0
+		self.dropped = 0
+		self.reported_dropped = 0
+		self.reconnections = 0
+		self.ended = False
+
+
+	def run(self):
+		"""
+		Reader thread: decodes the frames until the stream ends or the reader is stopped.
+		"""
+		try:
+			while not self.stop_event.is_set():
+				ret, image = self.video_stream.read()
+				if not ret:
+					if self.reconnect and self.open_again():
+						continue
+					break
+				self.delay = 1.0
+
+				# The time the frame arrived, so speeds do not depend on when it is processed.
+				timestamp = datetime.datetime.now()
+				with self.condition:
+					if self.frame is not None:
+						self.dropped += 1
+					self.frames += 1
+					self.frame = (self.frames, image, timestamp)
+					self.condition.notify()
+		finally:
+			with self.condition:
+				self.ended = True
+				self.condition.notify_all()
+
+
+	def open_again(self):
+		"""
+		Opens the stream again after it was lost. Returns False if the reader was stopped in the meantime. The delay
+		is doubled after each attempt, and only goes back to the start once a frame is read, so a stream that opens
+		but sends no frames is not opened again in a tight loop.
+		"""
+		while not self.stop_event.is_set():
+			print("[WARNING] The video stream was lost. Trying to open it again in %.0f s." % (self.delay))
+			self.video_stream.release()
+			if self.stop_event.wait(self.delay):
+				return False
+			self.video_stream = open_stream(self.source, self.width, self.height)
+			self.delay = min(self.delay * 2, self.max_delay)
+			if self.video_stream.isOpened():
+				self.reconnections += 1
+				print("[INFO]    The video stream was opened again.")
+				return True
+		return False
+
+
+	def read(self):
+		"""
+		Waits for a frame newer than the last one read. Returns the frame number, the image and the time it arrived,
+		or None once the stream has ended.
+		"""
+		with self.condition:
+			while self.frame is None:
+				if self.ended:
+					return None
+				self.condition.wait(poll_interval)
+			frame, self.frame = self.frame, None
+			return frame
+
+
+	def take_dropped(self):
+		"""
+		Returns the frames dropped since the last call.
+		"""
+		with self.condition:
+			dropped = self.dropped - self.reported_dropped
+			self.reported_dropped = self.dropped
+			return dropped
+
+
+	def stop(self, timeout = 2.0):
+		"""
+		Stops the reader and releases the stream.
+		"""
+		self.stop_event.set()
+		self.join(timeout)
+		# The stream cannot be released while it is being read, which may take long with a lost network stream.
+		if not self.is_alive():
+			self.video_stream.release()
@@ -0,0 +1,104 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import zipfile
+import numpy as np
+
+# Version of the snapshot layout. Snapshots of other versions are ignored.
+version = 2
+
+class Checkpoint():
+	"""
+	This class saves snapshots of the tracker and the counter to a file, so a restarted process carries on with
+	the vehicles that were being tracked. The snapshot is a single uncompressed .npz file with the arrays of both,
+	written to a temporary file first and then renamed over the previous one, so a crash while saving never
+	leaves a broken snapshot behind.
+	"""
+	def __init__(self, path, interval = 5.0, max_age = 10.0, id_block = 10000):
+		self.path = path
+		self.interval = float(interval)
+		self.max_age = float(max_age)
+		self.id_block = int(id_block)
+		self.last_save = time.monotonic()
+
+
+	def due(self):
+		"""
+		Returns True if the interval since the last snapshot has passed.
+		"""
+		return time.monotonic() - self.last_save >= self.interval
+
+
+	def save(self, tracker, counter, clean = False):
+		"""
+		Writes a snapshot of the tracker and the counter. A clean snapshot is the last one written before exiting.
+		"""
+		arrays = {"version": np.array(version), "saved": np.array(time.time()), "clean": np.array(clean)}
+		arrays.update(("tracker_" + key, value) for key, value in tracker.state().items())
+		arrays.update(("counter_" + key, value) for key, value in counter.state().items())
+
+		with open(self.path + ".tmp", "wb") as f:
+			np.savez(f, **arrays)
+		os.replace(self.path + ".tmp", self.path)
+		self.last_save = time.monotonic()
+
+
+	def load(self, tracker, counter):
+		"""
+		Restores the tracker and the counter from the last snapshot, if there is one. Returns True if it was restored.
+		"""
+		if not os.path.exists(self.path):
+			return False
+		try:
+			with np.load(self.path) as snapshot:
+				arrays = dict(snapshot.items())
+		except (OSError, ValueError, zipfile.BadZipFile) as e:
+			print("[WARNING] The checkpoint could not be read:", e)
+			return False
+		if int(arrays.get("version", -1)) != version:
+			print("[WARNING] The checkpoint has an unknown version and is ignored.")
+			return False
+
+		tracker_state = {key[8:]: value for key, value in arrays.items() if key.startswith("tracker_")}
+		counter_state = {key[8:]: value for key, value in arrays.items() if key.startswith("counter_")}
+
+		# After a crash, more IDs may have been given out after the last snapshot, so a block of them is skipped.
+		if not bool(arrays["clean"]):
+			tracker_state["count"] = tracker_state["count"] + self.id_block
+
+		# The vehicles of an old snapshot are long gone, only the IDs are kept unique.
+		age = time.time() - float(arrays["saved"])
+		fresh = 0 <= age <= self.max_age
+		tracker.restore(tracker_state, fresh)
+		counter.restore(counter_state, fresh)
+		if fresh:
+			print("[INFO]    Restored %d tracks and %d objects from the checkpoint of %.1f s ago." % (len(tracker_state["ids"]), len(counter.objects), age))
+		else:
+			print("[INFO]    The checkpoint is %.1f s old, only the IDs were restored." % (age))
+		return True
+
+
+def create_checkpoint(config):
+	"""
+	Returns the checkpoint of the configuration file, or None if it is disabled.
+	"""
+	if not config["checkpoint"]["path"]:
+		return None
+	return Checkpoint(config["checkpoint"]["path"], config["checkpoint"]["interval"], config["checkpoint"]["max_age"], config["checkpoint"]["id_block"])
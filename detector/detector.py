@@ -0,0 +1,365 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import cv2
+import numpy as np
+
+class Detector(object):
+	"""
+	Base class of the detector backends. Every backend returns the objects found in an image
+	as an array with a [x1, y1, x2, y2, score, class] row per object, in image pixels.
+	The time spent preprocessing, running and postprocessing the model in the last call is kept in timings.
+	"""
+	def __init__(self, threshold):
+		self.threshold = threshold
+		self.model_width = 0
+		self.model_height = 0
+		self.timings = {"preprocess": 0.0, "invoke": 0.0, "postprocess": 0.0}
+
+
+	def detect(self, image):
+		"""
+		Finds the objects in an image.
+		"""
+		raise NotImplementedError
+
+
+	def prepare_input(self):
+		"""
+		Finds the input tensor of a TensorFlow Lite interpreter. Used by the backends built on it.
+		"""
+		input_details = self.interpreter.get_input_details()[0]
+		self.input_index = input_details['index']
+		self.input_dtype = input_details['dtype']
+		self.model_height = input_details['shape'][1]
+		self.model_width = input_details['shape'][2]
+
+		# Function returning a view of the memory behind the input tensor.
+		self.input_tensor = self.interpreter.tensor(self.input_index)
+
+		# Float models need the resized frame as bytes before it is normalized, so a buffer is kept for it.
+		self.resized = None if self.input_dtype == np.uint8 else np.empty((self.model_height, self.model_width, 3), np.uint8)
+
+
+	def set_input(self, image):
+		"""
+		Resizes a BGR image and converts it to RGB right into the memory of the input tensor, without intermediate copies.
+		"""
+		tensor = self.input_tensor()[0]
+		size = (self.model_width, self.model_height)
+		if self.resized is None:
+			cv2.resize(image, size, dst = tensor, interpolation = cv2.INTER_AREA)
+			cv2.cvtColor(tensor, cv2.COLOR_BGR2RGB, dst = tensor)
+		else:
+			cv2.resize(image, size, dst = self.resized, interpolation = cv2.INTER_AREA)
+			cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst = self.resized)
+
+			# Float models expect the pixels between -1 and 1.
+			cv2.addWeighted(self.resized, 1 / 127.5, self.resized, 0.0, -1.0, dst = tensor, dtype = cv2.CV_32F)
+
+		# The interpreter refuses to run while a view of its memory is alive.
+		del tensor
+
+
+	def to_detections(self, boxes, scores, classes, image_width, image_height):
+		"""
+		Builds the detections array from normalized [ymin, xmin, ymax, xmax] boxes, dropping the ones below the threshold.
+		"""
+		keep = scores >= self.threshold
+		boxes = np.clip(boxes[keep], 0.0, 1.0)
+		detections = np.empty((len(boxes), 6))
+		detections[:, 0] = np.floor(boxes[:, 1] * image_width)
+		detections[:, 1] = np.floor(boxes[:, 0] * image_height)
+		detections[:, 2] = np.floor(boxes[:, 3] * image_width)
+		detections[:, 3] = np.floor(boxes[:, 2] * image_height)
+		detections[:, 4] = scores[keep]
+		detections[:, 5] = classes[keep]
+		return detections
+
+
+class EdgeTpuDetector(Detector):
+	"""
+	This class runs an object detection model on the Edge TPU.
+	"""
+	def __init__(self, model, threshold, device = None):
+		super().__init__(threshold)
+		from pycoral.adapters import detect
+		from pycoral.utils.edgetpu import make_interpreter
+		self.detect_objects = detect.get_objects
+
+		# TensorFlow Lite interpreter for the Edge TPU is initialized with the selected model.
+		self.interpreter = make_interpreter(model, device = device)
+
+		# Allocate memory for the model's input tensors.
+		self.interpreter.allocate_tensors()
+
+		# Find the model's input tensor, width and height.
+		self.prepare_input()
+
+
+	def detect(self, image):
+		"""
+		Finds the objects in an image. Returns an array with a [x1, y1, x2, y2, score, class] row per object.
+		"""
+		start = time.perf_counter()
+
+		# Input image width and height is retrieved.
+		input_height, input_width = image.shape[:2]
+
+		# And used to calculate the scale factors needed to map the boxes back to the image.
+		scaling_factor_x = self.model_width / input_width
+		scaling_factor_y = self.model_height / input_height
+
+		# Each frame is resized to meet the model requirements, straight into the input tensor.
+		self.set_input(image)
+		preprocessed = time.perf_counter()
+
+		# Run the inference model.
+		self.interpreter.invoke()
+		invoked = time.perf_counter()
+
+		# And find if there are objects in the frame.
+		objs = self.detect_objects(self.interpreter, self.threshold, (scaling_factor_x, scaling_factor_y))
+		detections = np.array([[obj.bbox.xmin, obj.bbox.ymin, obj.bbox.xmax, obj.bbox.ymax, obj.score, obj.id] for obj in objs]).reshape(-1, 6)
+		self.timings["preprocess"] = preprocessed - start
+		self.timings["invoke"] = invoked - preprocessed
+		self.timings["postprocess"] = time.perf_counter() - invoked
+		return detections
+
+
+class TfliteDetector(Detector):
+	"""
+	This class runs a TensorFlow Lite SSD model with the post-processing operator on the CPU.
+	The model must not be compiled for the Edge TPU.
+	"""
+	def __init__(self, model, threshold, threads = None):
+		super().__init__(threshold)
+		try:
+			from tflite_runtime.interpreter import Interpreter
+		except ImportError:
+			from tensorflow.lite import Interpreter
+
+		self.interpreter = Interpreter(model_path = model, num_threads = threads)
+		self.interpreter.allocate_tensors()
+		self.prepare_input()
+
+		# The outputs of the post-processing operator are boxes, classes, scores and count, in this order.
+		self.output_indexes = [output['index'] for output in self.interpreter.get_output_details()[:4]]
+
+
+	def detect(self, image):
+		"""
+		Finds the objects in an image. Returns an array with a [x1, y1, x2, y2, score, class] row per object.
+		"""
+		start = time.perf_counter()
+		input_height, input_width = image.shape[:2]
+		self.set_input(image)
+		preprocessed = time.perf_counter()
+		self.interpreter.invoke()
+		invoked = time.perf_counter()
+
+		boxes, classes, scores, count = (self.interpreter.get_tensor(index) for index in self.output_indexes)
+		count = int(count.flatten()[0])
+		detections = self.to_detections(boxes[0, :count], scores[0, :count], classes[0, :count], input_width, input_height)
+		self.timings["preprocess"] = preprocessed - start
+		self.timings["invoke"] = invoked - preprocessed
+		self.timings["postprocess"] = time.perf_counter() - invoked
+		return detections
+
+
+class OpenCvDetector(Detector):
+	"""
+	This class runs a TensorFlow SSD model (frozen graph and its text description) with the OpenCV DNN module on the CPU.
+	"""
+	def __init__(self, model, model_config, threshold, width = 300, height = 300, threads = None):
+		super().__init__(threshold)
+		if threads:
+			cv2.setNumThreads(threads)
+		self.net = cv2.dnn.readNet(model, model_config)
+		self.model_width = width
+		self.model_height = height
+
+
+	def detect(self, image):
+		"""
+		Finds the objects in an image. Returns an array with a [x1, y1, x2, y2, score, class] row per object.
+		"""
+		start = time.perf_counter()
+		input_height, input_width = image.shape[:2]
+		blob = cv2.dnn.blobFromImage(image, size = (self.model_width, self.model_height), swapRB = True)
+		self.net.setInput(blob)
+		preprocessed = time.perf_counter()
+		output = self.net.forward()
+		invoked = time.perf_counter()
+
+		# Each row is [image, class, score, xmin, ymin, xmax, ymax]. OpenCV counts the background as class 0.
+		output = output.reshape(-1, 7)
+		detections = self.to_detections(output[:, [4, 3, 6, 5]], output[:, 2], output[:, 1] - 1, input_width, input_height)
+		self.timings["preprocess"] = preprocessed - start
+		self.timings["invoke"] = invoked - preprocessed
+		self.timings["postprocess"] = time.perf_counter() - invoked
+		return detections
+
+
+# Fraction of the smaller box that has to lie inside another one, found by a different tile, for both to be merged.
+containment_threshold = 0.8
+
+# Pixels from an inner edge of a tile within which a box is taken as cut by that edge.
+edge_margin = 2
+
+def merge_detections(detections, tiles, cut, iou_threshold):
+	"""
+	Merges the boxes of the same object found by several tiles into their union, keeping the highest score.
+	Boxes of the same class from different tiles are merged when they overlap by more than the threshold, when
+	the smaller one lies mostly inside the other, or when both are cut by the edge of their tiles and touch each
+	other at about the same height, as happens with objects wider than the overlap of the tiles.
+	"""
+	order = np.argsort(-detections[:, 4], kind = "stable")
+	detections = detections[order]
+	tiles = tiles[order]
+	cut = cut[order]
+	used = np.zeros(len(detections), dtype = bool)
+	merged = []
+	for i in range(len(detections)):
+		if used[i]:
+			continue
+		box = detections[i].copy()
+		candidates = np.nonzero(~used[i + 1:] & (tiles[i + 1:] != tiles[i]) & (detections[i + 1:, 5] == box[5]))[0] + i + 1
+		if len(candidates):
+			others = detections[candidates]
+			w = np.maximum(0., np.minimum(box[2], others[:, 2]) - np.maximum(box[0], others[:, 0]))
+			h = np.maximum(0., np.minimum(box[3], others[:, 3]) - np.maximum(box[1], others[:, 1]))
+			intersection = w * h
+			area = (box[2] - box[0]) * (box[3] - box[1])
+			other_areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+			iou = intersection / np.maximum(area + other_areas - intersection, 1e-9)
+			contained = intersection / np.maximum(np.minimum(area, other_areas), 1e-9)
+			heights = np.maximum(box[3], others[:, 3]) - np.minimum(box[1], others[:, 1])
+			joined = cut[i] & cut[candidates] & (w > 0) & (h / np.maximum(heights, 1e-9) > iou_threshold)
+			matched = candidates[(iou > iou_threshold) | (contained > containment_threshold) | joined]
+			if len(matched):
+				used[matched] = True
+				box[:2] = np.minimum(box[:2], detections[matched, :2].min(axis = 0))
+				box[2:4] = np.maximum(box[2:4], detections[matched, 2:4].max(axis = 0))
+		merged.append(box)
+	return np.array(merged).reshape(-1, 6)
+
+
+class RegionDetector(Detector):
+	"""
+	This class runs another detector over some regions of the image only, instead of shrinking the whole frame.
+	Wide regions can be split into several overlapping tiles of about the model's aspect ratio, so small vehicles
+	keep more pixels at the model input. The boxes are mapped back to the whole image and the objects found by
+	two tiles are merged.
+	"""
+	def __init__(self, detector, regions, tiles = 1, overlap = 0.1, iou_threshold = 0.5):
+		super().__init__(detector.threshold)
+		self.detector = detector
+		self.model_width = detector.model_width
+		self.model_height = detector.model_height
+		self.regions = [tuple(int(v) for v in region) for region in regions]
+		self.iou_threshold = iou_threshold
+
+		# Each region is split horizontally, as roads usually cross the image from side to side.
+		self.tiles = []
+		self.inner_edges = []
+		for x1, y1, x2, y2 in self.regions:
+			n = int(tiles)
+			if n <= 0:
+				# As many tiles as needed for each of them to have the aspect ratio of the model.
+				model_ratio = self.model_width / self.model_height if self.model_height else 1.0
+				n = max(1, int(round((x2 - x1) / max(1, y2 - y1) / model_ratio)))
+			tile_width = (x2 - x1) / (n - (n - 1) * overlap)
+			step = tile_width * (1 - overlap)
+			for i in range(n):
+				left = x1 + int(round(i * step))
+				right = x2 if i == n - 1 else x1 + int(round(i * step + tile_width))
+				self.tiles.append((left, y1, right, y2))
+				self.inner_edges.append((i > 0, i < n - 1))
+		print("[INFO]    Detecting in %d regions, %d tiles." % (len(self.regions), len(self.tiles)))
+
+
+	def detect(self, image):
+		"""
+		Finds the objects in the regions of an image. Returns an array with a [x1, y1, x2, y2, score, class] row per object.
+		"""
+		timings = dict.fromkeys(self.timings, 0.0)
+		found = []
+		tile_ids = []
+		cut = []
+		for i, (x1, y1, x2, y2) in enumerate(self.tiles):
+			# The crop is a view of the frame, it is only copied when resized to the model input.
+			crop = image[y1:y2, x1:x2]
+			if crop.size == 0:
+				continue
+			detections = self.detector.detect(crop)
+			detections[:, [0, 2]] += x1
+			detections[:, [1, 3]] += y1
+			found.append(detections)
+			tile_ids.append(np.full(len(detections), i))
+
+			# Only the edges shared with another tile cut objects, the edges of the region are real limits.
+			left, right = self.inner_edges[i]
+			cut.append((left & (detections[:, 0] <= x1 + edge_margin)) | (right & (detections[:, 2] >= x2 - 1 - edge_margin)))
+			for stage, seconds in self.detector.timings.items():
+				timings[stage] += seconds
+
+		start = time.perf_counter()
+		if not found:
+			detections = np.empty((0, 6))
+		elif len(found) == 1:
+			detections = found[0]
+		else:
+			detections = merge_detections(np.concatenate(found), np.concatenate(tile_ids), np.concatenate(cut), self.iou_threshold)
+		timings["postprocess"] += time.perf_counter() - start
+		self.timings = timings
+		return detections
+
+
+def load_detector(config, device = None):
+	"""
+	Instantiates the detector backend selected in the configuration file with the selected model.
+	"""
+	backend = config["detector"]["backend"]
+	if backend == "edgetpu":
+		return EdgeTpuDetector(config["input"]["model"], config["detector"]["threshold"], device)
+	elif backend == "tflite":
+		return TfliteDetector(config["input"]["model"], config["detector"]["threshold"], config["detector"]["threads"])
+	elif backend == "opencv":
+		return OpenCvDetector(config["input"]["model"], config["detector"]["model_config"], config["detector"]["threshold"], threads = config["detector"]["threads"])
+	else:
+		raise ValueError("Unknown detector backend: " + str(backend))
+
+
+def limit_to_regions(detector, config):
+	"""
+	Limits a detector to the regions of interest of the configuration file, if there are any. Several cameras
+	can share the same loaded model this way, each with its own regions.
+	"""
+	if config["detector"]["regions"]:
+		detector = RegionDetector(detector, config["detector"]["regions"], config["detector"]["tiles"], config["detector"]["tile_overlap"],
+			config["detector"]["merge_threshold"])
+	return detector
+
+
+def create_detector(config, device = None):
+	"""
+	Instantiates the detector backend selected in the configuration file, limited to the regions of interest if there are any.
+	"""
+	return limit_to_regions(load_detector(config, device), config)
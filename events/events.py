@@ -0,0 +1,245 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import queue
+import threading
+import time
+import urllib.request
+
+# Seconds a sink waits on its queue before checking again if it has to stop.
+poll_interval = 0.1
+
+# Records handed to a sink at once, at most.
+batch_size = 50
+
+class Sink(threading.Thread):
+	"""
+	Base class of the outputs of the records. Each sink consumes the records from its own bounded queue on its own
+	thread, so a slow disk or broker does not stall the frame loop. When the queue is full, the record is either
+	dropped or the producer waits for room, as set by the policy.
+	"""
+	def __init__(self, name, queue_size = 1000, policy = "drop"):
+		super().__init__(name = "sink-" + name, daemon = True)
+		if policy not in ("drop", "block"):
+			raise ValueError("Unknown sink policy: " + str(policy))
+		self.sink_name = name
+		self.policy = policy
+		self.queue = queue.Queue(maxsize = queue_size)
+		self.stop_event = threading.Event()
+		self.received = 0
+		self.handled = 0
+		self.dropped = 0
+		self.errors = 0
+
+		# Time the records being handled right now were queued at.
+		self.in_flight = None
+
+
+	def put(self, record):
+		"""
+		Queues a record, following the policy when the queue is full. Called from the frame loop.
+		"""
+		self.received += 1
+		item = (time.monotonic(), record)
+		if self.policy == "drop":
+			try:
+				self.queue.put_nowait(item)
+			except queue.Full:
+				self.dropped += 1
+			return
+
+		while not self.stop_event.is_set():
+			try:
+				self.queue.put(item, timeout = poll_interval)
+				return
+			except queue.Full:
+				continue
+		self.dropped += 1
+
+
+	def handle(self, records):
+		"""
+		Outputs a batch of records. Implemented by each sink.
+		"""
+		raise NotImplementedError
+
+
+	def next_batch(self):
+		"""
+		Waits for a record and takes the ones queued behind it too, up to the batch size.
+		"""
+		try:
+			items = [self.queue.get(timeout = poll_interval)]
+		except queue.Empty:
+			return []
+		while len(items) < batch_size:
+			try:
+				items.append(self.queue.get_nowait())
+			except queue.Empty:
+				break
+		return items
+
+
+	def run(self):
+		"""
+		Sink thread: outputs the records until the sink is closed and its queue is empty.
+		"""
+		while not (self.stop_event.is_set() and self.queue.empty()):
+			items = self.next_batch()
+			if not items:
+				continue
+			self.in_flight = items[0][0]
+			try:
+				self.handle([record for queued, record in items])
+				self.handled += len(items)
+			except Exception as e:
+				self.errors += 1
+				print("[ERROR]   The '%s' sink could not output %d records: %s" % (self.sink_name, len(items), e))
+			self.in_flight = None
+
+
+	def lag(self):
+		"""
+		Returns how long the oldest record not output yet has been waiting, in seconds.
+		"""
+		oldest = self.in_flight
+		if oldest is None:
+			with self.queue.mutex:
+				if self.queue.queue:
+					oldest = self.queue.queue[0][0]
+		return time.monotonic() - oldest if oldest is not None else 0.0
+
+
+	def stats(self):
+		"""
+		Returns the state of the sink.
+		"""
+		return {"depth": self.queue.qsize(), "lag": self.lag(), "received": self.received, "handled": self.handled,
+			"dropped": self.dropped, "errors": self.errors}
+
+
+	def close(self, timeout = 10.0):
+		"""
+		Outputs the records still queued and stops the thread.
+		"""
+		self.stop_event.set()
+		self.join(timeout)
+
+
+class ReporterSink(Sink):
+	"""
+	This sink saves the records with a Reporter, to CSV files or to a database.
+	"""
+	def __init__(self, reporter, queue_size = 1000, policy = "block"):
+		super().__init__("report", queue_size, policy)
+		self.reporter = reporter
+
+
+	def handle(self, records):
+		for record in records:
+			self.reporter.data_save(record)
+
+
+class MqttSink(Sink):
+	"""
+	This sink publishes the records to a MQTT topic. The client groups them into batches by itself. The records of
+	each camera of a supervisor go to a subtopic named after the camera.
+	"""
+	def __init__(self, client, topic, queue_size = 1000, policy = "drop"):
+		super().__init__("mqtt", queue_size, policy)
+		self.client = client
+		self.topic = topic
+
+
+	def handle(self, records):
+		for record in records:
+			self.client.send(self.topic + "/" + record["camera"] if "camera" in record else self.topic, record)
+
+
+class WebhookSink(Sink):
+	"""
+	This sink posts the records to a HTTP endpoint as JSON, a batch per request.
+	"""
+	def __init__(self, url, timeout = 2.0, queue_size = 1000, policy = "drop"):
+		super().__init__("webhook", queue_size, policy)
+		self.url = url
+		self.timeout = timeout
+
+
+	def handle(self, records):
+		rows = []
+		for record in records:
+			row = {
+				"id": record["id"],
+				"x": record["position"][0],
+				"y": record["position"][1],
+				"timestamp": round(record["timestamp"].timestamp(), 3),
+				"direction": record["direction"],
+				"speed": record["speed"],
+				"class": record["class"]
+				}
+			if "camera" in record:
+				row["camera"] = record["camera"]
+			rows.append(row)
+		body = json.dumps({"records": rows}, separators = (',', ':')).encode()
+		request = urllib.request.Request(self.url, data = body, headers = {"Content-Type": "application/json"}, method = "POST")
+		with urllib.request.urlopen(request, timeout = self.timeout) as response:
+			response.read()
+
+
+class EventBus(object):
+	"""
+	This class hands every record to all the sinks, as soon as the vehicle is reported: when it crosses the last
+	reference line, or when it leaves the image without crossing them all.
+	"""
+	def __init__(self):
+		self.sinks = []
+
+
+	def add_sink(self, sink):
+		"""
+		Adds a sink and starts its thread.
+		"""
+		self.sinks.append(sink)
+		sink.start()
+
+
+	def publish(self, record):
+		"""
+		Queues a record in every sink.
+		"""
+		for sink in self.sinks:
+			sink.put(record)
+
+
+	def stats(self):
+		"""
+		Returns the state of each sink, by name.
+		"""
+		return {sink.sink_name: sink.stats() for sink in self.sinks}
+
+
+	def close(self):
+		"""
+		Outputs the records still queued in every sink and stops them.
+		"""
+		for sink in self.sinks:
+			sink.stop_event.set()
+		for sink in self.sinks:
+			sink.close()
@@ -0,0 +1,278 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds.
+bucket_bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Quantiles reported from the most recent samples.
+quantiles = (0.5, 0.9, 0.99)
+
+class Histogram(object):
+	"""
+	This class keeps the latency of a stage: cumulative buckets since the start, plus a ring of the most recent samples.
+	"""
+	def __init__(self, window = 1024):
+		self.buckets = [0] * (len(bucket_bounds) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.window = [0.0] * window
+		self.index = 0
+
+
+	def observe(self, seconds):
+		"""
+		Adds a new sample. Only a few additions are done here, as it is called several times per frame.
+		"""
+		self.buckets[bisect.bisect_left(bucket_bounds, seconds)] += 1
+		self.count += 1
+		self.sum += seconds
+		self.window[self.index % len(self.window)] = seconds
+		self.index += 1
+
+
+	def recent_quantiles(self):
+		"""
+		Returns the quantiles of the most recent samples.
+		"""
+		samples = sorted(self.window[:min(self.index, len(self.window))])
+		if not samples:
+			return {q: 0.0 for q in quantiles}
+		return {q: samples[min(int(q * len(samples)), len(samples) - 1)] for q in quantiles}
+
+
+class Metrics(object):
+	"""
+	This class gathers the health metrics of the pipeline: the latency of each stage, counters and gauges.
+	The labels, such as the camera, are added to every sample.
+	"""
+	def __init__(self, window = 1024, labels = None):
+		self.window = window
+		self.labels = dict(labels or {})
+		self.histograms = {}
+		self.counters = {}
+		self.gauges = {}
+		self.queue_depths = {}
+		self.sinks = {}
+		self.frame_times = [0.0] * 64
+		self.frames = 0
+		self.start = time.time()
+
+
+	def observe(self, stage, seconds):
+		"""
+		Records how long a stage took.
+		"""
+		histogram = self.histograms.get(stage)
+		if histogram is None:
+			histogram = self.histograms[stage] = Histogram(self.window)
+		histogram.observe(seconds)
+
+
+	def increment(self, name, value = 1):
+		"""
+		Increments a counter.
+		"""
+		self.counters[name] = self.counters.get(name, 0) + value
+
+
+	def set(self, name, value):
+		"""
+		Sets the value of a gauge.
+		"""
+		self.gauges[name] = value
+
+
+	def frame_done(self):
+		"""
+		Marks the end of the processing of a frame. Used to calculate the effective FPS.
+		"""
+		self.frame_times[self.frames % len(self.frame_times)] = time.perf_counter()
+		self.frames += 1
+
+
+	def fps(self):
+		"""
+		Returns the effective FPS over the most recent frames.
+		"""
+		n = min(self.frames, len(self.frame_times))
+		if n < 2:
+			return 0.0
+		newest = self.frame_times[(self.frames - 1) % len(self.frame_times)]
+		oldest = self.frame_times[(self.frames - n) % len(self.frame_times)]
+		return (n - 1) / (newest - oldest) if newest > oldest else 0.0
+
+
+	def stats(self):
+		"""
+		Returns a summary of the metrics as a dictionary, with the latencies in milliseconds.
+		"""
+		stages = {}
+		# Other threads, such as the render thread, may add stages, counters or gauges meanwhile.
+		for stage, histogram in list(self.histograms.items()):
+			recent = histogram.recent_quantiles()
+			stages[stage] = {"p50": round(recent[0.5] * 1000, 3), "p99": round(recent[0.99] * 1000, 3)}
+		stats = {"fps": round(self.fps(), 2), "frames": self.frames, "uptime": round(time.time() - self.start)}
+		stats.update(list(self.counters.items()))
+		stats.update(list(self.gauges.items()))
+		stats["queues"] = dict(self.queue_depths)
+		stats["sinks"] = {name: {"depth": sink["depth"], "lag": round(sink["lag"], 3), "dropped": sink["dropped"]} for name, sink in self.sinks.items()}
+		stats["stages"] = stages
+		return stats
+
+
+	def render(self):
+		"""
+		Returns the metrics in the Prometheus text format.
+		"""
+		return render_metrics([self])
+
+
+def label_set(metrics, **labels):
+	"""
+	Returns the labels of a sample in the Prometheus format, the ones of its metrics first.
+	"""
+	pairs = list(metrics.labels.items()) + list(labels.items())
+	if not pairs:
+		return ""
+	return "{" + ",".join('%s="%s"' % (name, value) for name, value in pairs) + "}"
+
+
+def render_metrics(group):
+	"""
+	Returns the metrics of several Metrics objects, told apart by their labels, in the Prometheus text format.
+	The samples of each metric are kept together, as the format requires.
+	"""
+	lines = []
+	lines.append("# HELP otd_stage_seconds Time spent in each stage of the pipeline.")
+	lines.append("# TYPE otd_stage_seconds histogram")
+	for metrics in group:
+		for stage, histogram in list(metrics.histograms.items()):
+			cumulative = 0
+			for bound, count in zip(bucket_bounds + ("+Inf",), histogram.buckets):
+				cumulative += count
+				lines.append('otd_stage_seconds_bucket%s %d' % (label_set(metrics, stage = stage, le = bound), cumulative))
+			lines.append('otd_stage_seconds_sum%s %f' % (label_set(metrics, stage = stage), histogram.sum))
+			lines.append('otd_stage_seconds_count%s %d' % (label_set(metrics, stage = stage), histogram.count))
+
+	lines.append("# HELP otd_stage_recent_seconds Time spent in each stage over the most recent frames.")
+	lines.append("# TYPE otd_stage_recent_seconds summary")
+	for metrics in group:
+		for stage, histogram in list(metrics.histograms.items()):
+			for q, value in histogram.recent_quantiles().items():
+				lines.append('otd_stage_recent_seconds%s %f' % (label_set(metrics, stage = stage, quantile = q), value))
+
+	lines.append("# HELP otd_fps Effective frames processed per second.")
+	lines.append("# TYPE otd_fps gauge")
+	for metrics in group:
+		lines.append("otd_fps%s %f" % (label_set(metrics), metrics.fps()))
+	lines.append("# HELP otd_frames_total Frames processed.")
+	lines.append("# TYPE otd_frames_total counter")
+	for metrics in group:
+		lines.append("otd_frames_total%s %d" % (label_set(metrics), metrics.frames))
+
+	# Each counter and gauge is written once, with the samples of every Metrics object that has it.
+	for name in dict.fromkeys(name for metrics in group for name in list(metrics.counters)):
+		lines.append("# TYPE otd_%s_total counter" % name)
+		for metrics in group:
+			if name in metrics.counters:
+				lines.append("otd_%s_total%s %d" % (name, label_set(metrics), metrics.counters[name]))
+	for name in dict.fromkeys(name for metrics in group for name in list(metrics.gauges)):
+		lines.append("# TYPE otd_%s gauge" % name)
+		for metrics in group:
+			if name in metrics.gauges:
+				lines.append("otd_%s%s %f" % (name, label_set(metrics), metrics.gauges[name]))
+
+	lines.append("# HELP otd_queue_depth Frames waiting at the output of each stage.")
+	lines.append("# TYPE otd_queue_depth gauge")
+	for metrics in group:
+		for name, depth in list(metrics.queue_depths.items()):
+			lines.append('otd_queue_depth%s %d' % (label_set(metrics, queue = name), depth))
+
+	sinks = [(metrics, name, sink) for metrics in group for name, sink in list(metrics.sinks.items())]
+	lines.append("# HELP otd_sink_queue_depth Records waiting in the queue of each output.")
+	lines.append("# TYPE otd_sink_queue_depth gauge")
+	for metrics, name, sink in sinks:
+		lines.append('otd_sink_queue_depth%s %d' % (label_set(metrics, sink = name), sink["depth"]))
+	lines.append("# HELP otd_sink_lag_seconds Time the oldest record not output yet has been waiting.")
+	lines.append("# TYPE otd_sink_lag_seconds gauge")
+	for metrics, name, sink in sinks:
+		lines.append('otd_sink_lag_seconds%s %f' % (label_set(metrics, sink = name), sink["lag"]))
+	for counter in ("handled", "dropped", "errors"):
+		lines.append("# TYPE otd_sink_%s_total counter" % counter)
+		for metrics, name, sink in sinks:
+			lines.append('otd_sink_%s_total%s %d' % (counter, label_set(metrics, sink = name), sink[counter]))
+	return "\n".join(lines) + "\n"
+
+
+class MetricsGroup(object):
+	"""
+	This class serves several Metrics objects as one, for example one per camera, each with its own labels.
+	"""
+	def __init__(self, group):
+		self.group = group
+
+
+	def render(self):
+		"""
+		Returns the metrics of the whole group in the Prometheus text format.
+		"""
+		return render_metrics(self.group)
+
+
+class MetricsServer(object):
+	"""
+	This class serves the metrics over HTTP, in the Prometheus text format, on its own thread.
+	"""
+	def __init__(self, metrics, host = "127.0.0.1", port = 9100):
+		self.metrics = metrics
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler):
+				if handler.path.split("?")[0] != "/metrics":
+					handler.send_error(404)
+					return
+				body = metrics.render().encode()
+				handler.send_response(200)
+				handler.send_header("Content-Type", "text/plain; version=0.0.4")
+				handler.send_header("Content-Length", str(len(body)))
+				handler.end_headers()
+				handler.wfile.write(body)
+
+			def log_message(handler, format, *args):
+				# Every scrape would be printed otherwise.
+				pass
+
+		self.server = ThreadingHTTPServer((host, port), Handler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target = self.server.serve_forever, name = "metrics", daemon = True)
+		self.thread.start()
+		print("[INFO]    Metrics available at: http://%s:%d/metrics" % (host, port))
+
+
+	def stop(self):
+		"""
+		Stops the HTTP server.
+		"""
+		self.server.shutdown()
+		self.server.server_close()
@@ -0,0 +1,80 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cv2
+import numpy as np
+
+class MotionGate(object):
+	"""
+	This class tells whether anything is moving in the regions of interest, so the detector can be skipped
+	on static frames. Each region is shrunk to a small grayscale image and compared with a running average
+	of the previous ones, so slow vehicles stand out as a whole and not only by their edges. Objects that
+	stop, as well as slow changes of light, blend into the background after a while.
+	"""
+	# Weight of each new frame in the background.
+	learning_rate = 0.05
+
+	def __init__(self, regions = None, width = 160, threshold = 25, min_area = 0.002, hold_frames = 10):
+		self.regions = [tuple(int(v) for v in region) for region in regions] if regions else [None]
+		self.width = width
+		self.threshold = threshold
+		self.min_area = min_area
+		self.hold_frames = hold_frames
+		self.backgrounds = [None] * len(self.regions)
+		self.hold = 0
+
+
+	def shrink(self, image):
+		"""
+		Returns a small, blurred grayscale version of an image. Averaging the pixels removes most of the sensor noise.
+		"""
+		height, width = image.shape[:2]
+		size = (self.width, max(1, int(round(height * self.width / width))))
+		small = cv2.resize(image, size, interpolation = cv2.INTER_AREA)
+		small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+		return cv2.GaussianBlur(small, (5, 5), 0)
+
+
+	def moving(self, image):
+		"""
+		Returns True if a large enough part of any region differs from its background. The detector keeps
+		running for some frames after the motion stops, so slow vehicles are not lost while they leave.
+		"""
+		motion = False
+		for i, region in enumerate(self.regions):
+			crop = image if region is None else image[region[1]:region[3], region[0]:region[2]]
+			if crop.size == 0:
+				continue
+			small = self.shrink(crop)
+			if self.backgrounds[i] is None:
+				self.backgrounds[i] = small.astype(np.float32)
+				motion = True
+				continue
+			diff = cv2.absdiff(small, cv2.convertScaleAbs(self.backgrounds[i]))
+			cv2.accumulateWeighted(small, self.backgrounds[i], self.learning_rate)
+			_, changed = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+			if cv2.countNonZero(changed) > self.min_area * changed.size:
+				motion = True
+
+		if motion:
+			self.hold = self.hold_frames
+			return True
+		if self.hold > 0:
+			self.hold -= 1
+			return True
+		return False
@@ -16,18 +16,100 @@
 	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import json
+import os
+import threading
 import uuid
 import paho.mqtt.client as paho
 
+# Columns of each record inside a batch message.
+record_fields = ["id", "x", "y", "timestamp", "direction", "speed", "class"]
+
+def encode_record(record):
+    """
+    Converts a record into a compact row. The timestamp is sent as Unix time with millisecond precision.
+    """
+    return [record["id"], record["position"][0], record["position"][1], round(record["timestamp"].timestamp(), 3),
+        record["direction"], record["speed"], record["class"]]
+
+
+class Spool():
+    """
+    This class keeps the messages that could not be sent in a file, one JSON object per line, so they
+    survive a restart. When it is full, the oldest messages are dropped.
+    """
+    def __init__(self, path, max_messages = 10000):
+        self.path = path
+        self.max_messages = max_messages
+        self.count = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.count = sum(1 for line in f)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, topic, payload):
+        """
+        Saves a message to the end of the spool.
+        """
+        if self.count >= self.max_messages:
+            # A tenth of the spool is dropped at once, so the file is not rewritten for every new message.
+            self.drop_oldest(max(1, self.max_messages // 10))
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({"topic": topic, "payload": payload}, separators = (',', ':')) + "\n")
+        self.count += 1
+
+    def drop_oldest(self, n):
+        """
+        Removes the oldest messages of the spool.
+        """
+        messages = self.read()[n:]
+        self.write(messages)
+        print("[WARNING] MQTT spool full, %d messages dropped." % (n))
+
+    def read(self):
+        """
+        Returns all the messages of the spool as (topic, payload) tuples, oldest first.
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [(m["topic"], m["payload"]) for m in (json.loads(line) for line in f if line.strip())]
+
+    def write(self, messages):
+        """
+        Replaces the content of the spool.
+        """
+        with open(self.path + ".tmp", 'w') as f:
+            for topic, payload in messages:
+                f.write(json.dumps({"topic": topic, "payload": payload}, separators = (',', ':')) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        self.count = len(messages)
+
+
 class MqttClient():
     """
 	This class is used to create a MQTT client and publishing and subscribing to topics.
+	Records are grouped into batches, sent as compact JSON. While the broker cannot be reached,
+	the batches are saved to a spool on disk and sent again once the connection is back.
 	"""
-    def __init__(self, host, port, keep_alive = 60, deviceId = str(uuid.getnode())):
+    def __init__(self, host, port, keep_alive = 60, deviceId = str(uuid.getnode()), qos = 1, batch_size = 20, batch_interval = 5.0,
+        spool_path = None, spool_size = 10000, verbose = False):
         self.id = str(deviceId)
         self.host = str(host)
         self.port = int(port)
         self.keep_alive = int(keep_alive)
+        self.qos = int(qos)
+        self.batch_size = int(batch_size)
+        self.batch_interval = float(batch_interval)
+        self.verbose = verbose
+        self.spool = Spool(spool_path, spool_size) if spool_path else None
+        self.connected = False
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
 
         # MQTT connection.
         self.client =  paho.Client(client_id = self.id, clean_session = False)
@@ -38,18 +120,22 @@ class MqttClient():
         self.client.on_message = self.on_message
         self.client.on_publish = self.on_publish
 
+        # The network loop keeps trying to connect in the background, also when the broker is not reachable at startup.
+        self.client.reconnect_delay_set(min_delay = 1, max_delay = 60)
         try:
-            # Connect.
-            self.client.connect(self.host, self.port, keepalive = self.keep_alive)
-
-            # Start loop.
+            self.client.connect_async(self.host, self.port, keepalive = self.keep_alive)
             self.client.loop_start()
 
         except Exception as e:
             print("[WARNING] Could not connect to MQTT server.")
 
+        # The batches are sent from their own thread.
+        self.thread = threading.Thread(target = self.run, name = "mqtt", daemon = True)
+        self.thread.start()
+
     def on_publish(self, client, userdata, mid):
-        print("[INFO]    Successfully sent MQTT with MID: " + str(mid))
+        if self.verbose:
+            print("[INFO]    Successfully sent MQTT with MID: " + str(mid))
 
     def on_message(self, client, userdata, msg):
         """
@@ -58,16 +144,92 @@ class MqttClient():
 
     def on_connect(self, client, userdata, flags, result_code):
         if result_code == 0:
+            self.connected = True
             print("[INFO]    Successfully connected to MQTT broker.")
+            # The spooled messages are sent as soon as possible.
+            self.flush_event.set()
         else:
             print("[INFO]    Failed to connect to MQTT broker: " + paho.connack_string(result_code))
 
     def on_disconnect(self, client, userdata, result_code):
+        self.connected = False
         print("[INFO]    Disconnected from MQTT broker.")
-    
-    def publish(self, topic, message, qos = 2):
-        (rc, mid) = self.client.publish(str(topic), str(message), qos = qos)
-    
+
+    def publish(self, topic, message, qos = None):
+        """
+        Sends a message right away. Returns False if it could not be sent.
+        """
+        if not self.connected:
+            return False
+        (rc, mid) = self.client.publish(str(topic), str(message), qos = self.qos if qos is None else qos)
+        return rc == paho.MQTT_ERR_SUCCESS
+
+    def send(self, topic, record):
+        """
+        Adds a record to the batch of a topic. The batch is sent when it is full or after the batch interval.
+        """
+        with self.lock:
+            batch = self.batches.setdefault(topic, [])
+            batch.append(encode_record(record))
+            full = len(batch) >= self.batch_size
+        if full:
+            self.flush_event.set()
+
+    def send_all(self, messages):
+        """
+        Sends (topic, payload) messages in order until one fails. Returns how many were sent.
+        """
+        for i, (topic, payload) in enumerate(messages):
+            if not self.publish(topic, payload):
+                return i
+        return len(messages)
+
+    def flush(self):
+        """
+        Sends the pending batches and, if connected, the spooled ones. Only called from the batch thread.
+        """
+        with self.lock:
+            batches, self.batches = self.batches, {}
+        messages = [(topic, json.dumps({"device": self.id, "fields": record_fields, "rows": rows}, separators = (',', ':')))
+            for topic, rows in batches.items() if rows]
+
+        # The spooled messages go first. The spool is only rewritten, with the messages that could not be sent,
+        # once the others were handed to the client, so a crash while they are sent does not lose any of them.
+        spooled = []
+        if self.spool is not None and len(self.spool) and self.connected:
+            spooled = self.spool.read()
+        sent = self.send_all(spooled)
+        if spooled:
+            self.spool.write(spooled[sent:])
+
+        # The new batches are only sent if the spool was emptied, so the order is kept.
+        unsent = messages if sent < len(spooled) else messages[self.send_all(messages):]
+        if unsent:
+            if self.spool is not None:
+                for topic, payload in unsent:
+                    self.spool.append(topic, payload)
+            else:
+                print("[WARNING] %d MQTT messages could not be sent." % (len(unsent)))
+
+    def run(self):
+        """
+        Batch thread: sends the batches when one is full or every batch interval.
+        """
+        while not self.stop_event.is_set():
+            self.flush_event.wait(self.batch_interval)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("[ERROR]   Could not send the MQTT messages:", e)
+
     def disconnect(self):
+        """
+        Sends or spools the pending batches and closes the connection.
+        """
+        self.stop_event.set()
+        self.flush_event.set()
+        self.thread.join()
+        self.flush()
         self.client.disconnect()
-        self.client.loop_stop()
\ No newline at end of file
+        self.client.loop_stop()
@@ -19,68 +19,114 @@
 """
 
 import datetime
-from utils.utils import find_nearest
+import numpy as np
+
+# Columns of the trajectory of an object: frame, time, position in the image and position on the road.
+FRAME, TIME, X, Y, GROUND_X, GROUND_Y = range(6)
+
+# Positions kept by default for each object.
+default_capacity = 256
 
 class ObjectToTrack(object):
 	"""
-	This class represent the objects that are going to be tracked.
+	This class represent the objects that are going to be tracked. The trajectory is kept in a ring buffer of
+	(frame, time, x, y, ground x, ground y) rows with a fixed capacity, so the memory used by an object does not
+	grow with the time it is tracked. Once it is full, the oldest positions are overwritten. The reference lines
+	are distances along the road, in metres, crossed by the ground x.
 	"""
-	def __init__(self, vehicleId, vehicleClass, position, frame, timestamp):
+	__slots__ = ("id", "object_class", "track", "size", "head", "last_timestamp", "lines", "crossings", "crossing_directions",
+		"frames_since_seen", "frames_seen", "frame_last_seen", "counted", "direction", "speed", "reported")
+
+	def __init__(self, vehicleId, vehicleClass, position, ground_position, frame, timestamp, lines, capacity = default_capacity):
 		self.id = vehicleId
 		self.object_class = vehicleClass
-		self.positions = [position]
-		self.timestamps = [timestamp]
-		self.time_ref = {"A": 0, "B": 0, "C": 0, "D": 0}
-		self.pixel_ref = {"A": None, "B": None, "C": None, "D": None}
+		self.track = np.empty((capacity, 6))
+		self.size = 0
+		self.head = 0
+		self.last_timestamp = None
+		self.lines = lines
+		self.crossings = [None] * len(lines)
+		self.crossing_directions = [0] * len(lines)
 		self.frames_since_seen = 0
 		self.frames_seen = 0
 		self.frame_last_seen = frame
 		self.counted = False
 		self.direction = 0
 		self.speed = 0
-		self.speed_ready = False
+		self.reported = False
+		self.append(position, ground_position, frame, timestamp)
+
+
+	def append(self, position, ground_position, frame, timestamp):
+		"""
+		Writes a row into the trajectory, over the oldest one if it is full.
+		"""
+		timestamp = timestamp if timestamp is not None else datetime.datetime.now()
+		time = timestamp.timestamp()
+		if self.size > 0:
+			previous = self.track[self.head - 1]
+			self.check_crossings(float(previous[GROUND_X]), float(previous[TIME]), float(ground_position[0]), time)
+		row = self.track[self.head]
+		row[FRAME] = frame
+		row[TIME] = time
+		row[X] = position[0]
+		row[Y] = position[1]
+		row[GROUND_X] = ground_position[0]
+		row[GROUND_Y] = ground_position[1]
+		self.head = (self.head + 1) % len(self.track)
+		self.size = min(self.size + 1, len(self.track))
+		self.last_timestamp = timestamp
+
+
+	def trajectory(self):
+		"""
+		Returns the rows of the trajectory kept so far. They are in time order until the buffer wraps around.
+		"""
+		return self.track[:self.size]
 
 
 	def last_position(self):
 		"""
 		Just returns the last position of the object.
 		"""
-		return self.positions[-1]
+		row = self.track[self.head - 1]
+		return (int(row[X]), int(row[Y]))
 
 
-	def add_position(self, new_position, frame):
+	def add_position(self, new_position, ground_position, frame, timestamp = None):
 		"""
-		Adds a new position to the object's position array.
+		Adds a new position to the object's trajectory. The wall clock is used if no timestamp is given.
 		"""
-		self.positions.append(new_position)
-		self.timestamps.append(datetime.datetime.now())
+		self.append(new_position, ground_position, frame, timestamp)
 		self.frames_since_seen = 0
 		self.frames_seen += 1
 		self.frame_last_seen = frame
-	
 
-	def find_references(self):
+
+	def check_crossings(self, x0, t0, x1, t1):
+		"""
+		Finds the reference lines crossed between the last position and the new one. The time of each crossing is
+		interpolated between both frames, so it does not depend on where the frames happened to land.
+		"""
+		for i, line in enumerate(self.lines):
+			if (x0 >= line) != (x1 >= line):
+				self.crossings[i] = t0 + (line - x0) / (x1 - x0) * (t1 - t0)
+				self.crossing_directions[i] = 1 if x1 > x0 else -1
+
+
+	def crossed_lines(self):
+		"""
+		Returns the indices of the reference lines crossed in the same direction as the last crossing, in order.
+		"""
+		crossed = [i for i, direction in enumerate(self.crossing_directions) if direction != 0]
+		if not crossed:
+			return []
+		last = max(crossed, key = lambda i: self.crossings[i])
+		return [i for i in crossed if self.crossing_directions[i] == self.crossing_directions[last]]
+
+
+	def crossed_all_lines(self):
 		"""
-		Finds the closest references from the object's position array.
+		Returns True once the object has crossed every reference line, all of them in the same direction.
 		"""
-		x_positions, y_positions = zip(*self.positions)
-
-		# Nearest reference to point A.
-		array_id = find_nearest(x_positions, 790)
-		self.pixel_ref["A"] = x_positions[array_id]
-		self.time_ref["A"] = self.timestamps[array_id]
-
-		# Nearest reference to point B.
-		array_id = find_nearest(x_positions, 740)
-		self.pixel_ref["B"] = x_positions[array_id]
-		self.time_ref["B"] = self.timestamps[array_id]
-
-		# Nearest reference to point C.
-		array_id = find_nearest(x_positions, 670)
-		self.pixel_ref["C"] = x_positions[array_id]
-		self.time_ref["C"] = self.timestamps[array_id]
-
-		# Nearest reference to point D.
-		array_id = find_nearest(x_positions, 590)
-		self.pixel_ref["D"] = x_positions[array_id]
-		self.time_ref["D"] = self.timestamps[array_id]
\ No newline at end of file
+		return self.crossing_directions[0] != 0 and self.crossing_directions.count(self.crossing_directions[0]) == len(self.lines)
@@ -0,0 +1,62 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import datetime
+import yaml
+
+from batch.batch import find_videos, run_batch, default_workers
+
+
+def main():
+	"""
+	Processes a set of recorded videos in parallel and writes a single merged report.
+	"""
+	parser = argparse.ArgumentParser(description = "Open Traffic Detector batch processing of recorded videos.")
+	parser.add_argument("inputs", nargs = "+", help = "Video files, directories or glob patterns.")
+	parser.add_argument("-w", "--workers", type = int, default = None, help = "Number of worker processes. By default, one per Edge TPU with the edgetpu backend, or one per CPU core.")
+	parser.add_argument("-c", "--config", default = "./config.yml", help = "Configuration file.")
+	parser.add_argument("-o", "--output", default = None, help = "Merged report file.")
+	args = parser.parse_args()
+
+	# The configuration file is read. The content of the YAML file is loaded into a dictionary.
+	config = yaml.safe_load(open(args.config))
+
+	videos = find_videos(args.inputs)
+	if not videos:
+		print("[ERROR]   No video files were found.")
+		return
+
+	# By default, the merged report is saved to the logs folder.
+	output = args.output or config["result"]["logs"] + "batch-" + datetime.datetime.now().strftime('%d-%m-%Y-%H-%M-%S') + ".csv"
+	workers = args.workers
+	if workers is None:
+		workers = default_workers(config)
+		if workers == 0:
+			print("[ERROR]   No Edge TPU was found.")
+			return
+	workers = max(1, min(workers, len(videos)))
+	print("[INFO]    Processing %d files with %d workers." % (len(videos), workers))
+
+	try:
+		run_batch(videos, config, workers, output, config["pipeline"]["report_interval"])
+	except KeyboardInterrupt:
+		print("[INFO]    Exiting gracefully. Bye!")
+
+if __name__ == '__main__':
+	main()
@@ -16,20 +16,30 @@
 	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import concurrent.futures
 import cv2
 import numpy as np
-import math
+import time
+import datetime
+import json
 import yaml
 
-from pycoral.adapters import common
-from pycoral.adapters import detect
-from pycoral.utils.dataset import read_label_file
-from pycoral.utils.edgetpu import make_interpreter
+from detector.detector import create_detector
 from sort.sort import Sort
+from sort.batch import BatchSort
 from tracker.tracker import ObjectCounter
+from calibration.calibration import create_calibration
+from checkpoint.checkpoint import create_checkpoint
 from utils.utils import *
 from reporter.reporter import Reporter
+from reporter.database import DatabaseReporter
 from mqtt.mqtt import MqttClient
+from events.events import EventBus, ReporterSink, MqttSink, WebhookSink
+from pipeline.pipeline import Pipeline, Frame, Cadence
+from capture.capture import LiveStream
+from motion.motion import MotionGate
+from metrics.metrics import Metrics, MetricsServer
+from render.render import Renderer, PreviewServer, Recorder
 
 
 def main():
@@ -40,125 +50,279 @@ def main():
 	# The configuration file is read. The content of the YAML file is loaded into a dictionary.
 	config = yaml.safe_load(open("./config.yml"))
 
-	# The labels file is read. Will be used by the Edge TPU detector.
+	# The labels file is read. Will be used to show the detections.
 	labels = read_label_file(config["input"]["labels"]) if config["input"]["labels"] else {}
 
-	# TensorFlow Lite interpreter for the Edge TPU is initialized with the selected model.
-	interpreter = make_interpreter(config["input"]["model"])
+	# Opening the video stream can take seconds for a RTSP camera, as does loading the model, so both are done at the same time.
+	stream_opener = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+	stream_future = stream_opener.submit(open_stream, config["input"]["source"], config["input"]["width"], config["input"]["height"])
 
-	# Allocate memory for the model's input tensors.
-	interpreter.allocate_tensors()
+	# The detector backend selected in the configuration file is initialized with the selected model.
+	detector = create_detector(config)
 
-	# Find the model's input width and height.
-	model_size = interpreter.get_input_details()
-	model_height = model_size[0]['shape'][1]
-	model_width = model_size[0]['shape'][2]
+	# The SORT class object is instantiated. The batch backend gives the same results as the reference one, only faster.
+	tracker_backend = BatchSort if config["tracker"]["backend"] == "batch" else Sort
+	tracker = tracker_backend(max_age = config["tracker"]["max_age"], min_hits = config["tracker"]["min_hits"], iou_threshold = config["tracker"]["iou_threshold"])
 
-	# The SORT class object is instantiated.
-	tracker = Sort(max_age = config["tracker"]["max_age"], min_hits = config["tracker"]["min_hits"], iou_threshold = config["tracker"]["iou_threshold"])
+	# Setup the video stream, once it has been opened.
+	videoStream = stream_future.result()
+	stream_opener.shutdown()
 
-	# Setup the video stream.
-	videoStream = cv2.VideoCapture(config["input"]["source"])
+	# In offline mode the video is processed as fast as possible, so the time of each frame has to be
+	# taken from the stream's own clock instead of the wall clock. The video output is disabled too.
+	offline = config["input"]["offline"]
+	media_clock = offline or config["input"]["clock"] == "media"
+	show_output = config["result"]["output"] and not offline
+	stream_start = datetime.datetime.now()
+	stream_fps = videoStream.get(cv2.CAP_PROP_FPS)
 
 	# The ObjectCounter class object is instantiated.
-	counter = ObjectCounter(videoStream)
+	counter = ObjectCounter(videoStream, config["tracker"]["history"], create_calibration(config))
 
-	# The Reporter class object is instantiated.
-	reporter = Reporter(config["result"]["logs"])
+	# The tracks and objects of the last run are restored, so the vehicles crossing at that moment are neither lost
+	# nor counted twice. The media clock starts again with the video, so there is nothing to carry on in offline mode.
+	checkpoint = create_checkpoint(config) if not offline else None
+	if checkpoint is not None:
+		checkpoint.load(tracker, counter)
+
+	# The Reporter class object is instantiated. Records are saved either to CSV files or to a database.
+	if config["result"]["backend"] == "sqlite":
+		reporter = DatabaseReporter(config["result"]["database"], config["result"]["buffer_size"], config["result"]["flush_interval"], config["result"]["fsync"])
+	else:
+		reporter = Reporter(config["result"]["logs"], config["result"]["buffer_size"], config["result"]["flush_interval"], config["result"]["fsync"],
+			config["result"]["rotate_size"] * 1024 * 1024, config["result"]["rotate_daily"])
 
 	# The MqttClient class object is instantiated.
-	client = MqttClient(config["mqtt"]["broker"], config["mqtt"]["port"])
+	client = MqttClient(config["mqtt"]["broker"], config["mqtt"]["port"], qos = config["mqtt"]["qos"], batch_size = config["mqtt"]["batch_size"],
+		batch_interval = config["mqtt"]["batch_interval"], spool_path = config["mqtt"]["spool"], spool_size = config["mqtt"]["spool_size"],
+		verbose = config["result"]["verbose"])
 
-	# The while loop is executed until a SIGINT is received.
-	try:
-		while True:		
-			
-			# Each one of the video frames will be processed.
-			ret, frame = videoStream.read()
+	# The EventBus class object is instantiated. Each output consumes the records on its own thread, so a slow
+	# disk, broker or web server does not stall the frame loop.
+	bus = EventBus()
+	bus.add_sink(ReporterSink(reporter, config["events"]["queue_size"], config["events"]["report_policy"]))
+	bus.add_sink(MqttSink(client, config["mqtt"]["topic"], config["events"]["queue_size"], config["events"]["mqtt_policy"]))
+	if config["events"]["webhook_url"]:
+		bus.add_sink(WebhookSink(config["events"]["webhook_url"], config["events"]["webhook_timeout"], config["events"]["queue_size"],
+			config["events"]["webhook_policy"]))
+
+	# The Pipeline class object is instantiated. Small queues between stages keep the latency low.
+	pipeline = Pipeline(config["pipeline"]["queue_size"])
+
+	# The Cadence class object is instantiated. The tracker fills in the frames that are not run through the detector.
+	# There is no live stream to keep up with in offline mode, so the interval is only adapted to the lag when online.
+	cadence = Cadence(config["pipeline"]["detection_interval"], config["pipeline"]["max_detection_interval"],
+		config["pipeline"]["target_lag"], config["pipeline"]["adaptive"] and not offline)
+
+	# The MotionGate class object is instantiated. Frames where nothing moves are not run through the detector.
+	motion_gate = None
+	if config["motion"]["enabled"]:
+		motion_gate = MotionGate(config["detector"]["regions"], config["motion"]["width"], config["motion"]["threshold"],
+			config["motion"]["min_area"], config["motion"]["hold_frames"])
+
+	# The Metrics class object is instantiated. The time spent in each stage is recorded there.
+	metrics = Metrics()
+	metrics.increment("frames_dropped", 0)
+	metrics.increment("frames_predicted", 0)
+	metrics.increment("frames_static", 0)
+	metrics_server = None
+	if config["metrics"]["enabled"]:
+		metrics_server = MetricsServer(metrics, config["metrics"]["host"], config["metrics"]["port"])
+
+	# The Renderer class object is instantiated if the frames have to be shown, served or recorded.
+	renderer = None
+	preview = None
+	recorder = None
+	if config["render"]["preview"]:
+		preview = PreviewServer(config["render"]["host"], config["render"]["port"], config["render"]["max_fps"],
+			config["render"]["quality"], config["render"]["width"])
+	if config["render"]["record"]:
+		recorder = Recorder(config["render"]["record"], stream_fps, config["render"]["record_scale"], config["render"]["record_codec"])
+	if show_output or preview is not None or recorder is not None:
+		renderer = Renderer(labels, config["detector"]["regions"], show_output, preview, recorder, metrics)
+		metrics.increment("frames_not_rendered", 0)
+		renderer.start()
+
+	# In latest mode, a live stream is read on its own thread and only the newest frame is processed, so the
+	# latency stays bounded when the processing is slower than the camera. Recorded videos are always read in order.
+	live_stream = None
+	if config["input"]["capture"] == "latest" and not offline:
+		live_stream = LiveStream(videoStream, config["input"]["source"], config["input"]["width"], config["input"]["height"],
+			config["input"]["reconnect"], config["input"]["reconnect_max_delay"])
 
-			if not(ret):
+	# Number of the last frame read from the video stream.
+	frame_index = 0
+
+	def capture():
+		"""
+		Capture stage: decodes the next frame of the video stream, or takes the newest one in latest mode.
+		"""
+		nonlocal frame_index
+		start = time.perf_counter()
+		if live_stream is not None:
+			frame = live_stream.read()
+			metrics.observe("read", time.perf_counter() - start)
+			metrics.increment("frames_dropped", live_stream.take_dropped())
+			if frame is None:
+				print("[ERROR]   The video stream has ended.")
+				return None
+			frame_index, image, timestamp = frame
+			return Frame(frame_index, image, timestamp)
+
+		ret, image = videoStream.read()
+		metrics.observe("read", time.perf_counter() - start)
+		if not(ret):
+			if offline:
+				print("[INFO]    End of the video stream.")
+			else:
 				print("[ERROR]   The video frame could not be read.")
-				break
-			
-			# Input image width and height is retrieved.
-			input_height, input_width = frame.shape[:2]
-
-			# And used to calculate the scale factors needed to properly show the resulting video.
-			scaling_factor_x = model_width / input_width
-			scaling_factor_y = model_height / input_height
-
-			# Vector that will store the objects identities assigned by the tracker.
-			tracked_objs = np.empty((0, 5))
-
-			# Vector that will store the objects found by the detector.
-			detected_objs = np.empty((0, 5))
-
-			# Vector that will store objects identities as well as their classes.
-			completed_objs = np.empty((0, 6))
-				
-			# Each frame is resized to meet the model requirements.
-			new_frame = cv2.resize(frame, (model_height, model_width), interpolation = cv2.INTER_AREA)
-			
-			# And copy that into the input tensors.
-			common.set_input(interpreter, new_frame)
-
-			# Run the inference model.
-			interpreter.invoke()
-
-			# And find if there are objects in the frame.
-			objs = detect.get_objects(interpreter, config["detector"]["threshold"], (scaling_factor_x, scaling_factor_y))
-
-			# If there are, then we need to prepare the vectors.
-			if objs:
-				for obj in objs:
-					# We are only intrested in two types of object classes: "car" or "truck".
-					if(obj.id == 2 or obj.id == 7):
-						# In these two vectors, we need to append boxes coordinates, their scores and their classes.
-						tracked_objs = np.append(tracked_objs, np.array([[obj.bbox.xmin, obj.bbox.ymin, obj.bbox.xmax, obj.bbox.ymax, obj.score]]), axis=0)
-						detected_objs = np.append(detected_objs, np.array([[obj.bbox.xmin, obj.bbox.ymin, obj.bbox.xmax, obj.bbox.ymax, obj.id]]), axis=0)
-			
-			if tracked_objs.size != 0:
-				# And if the detected objects vector is not empty, then it is shared with the tracker.
-				trackers = tracker.update(tracked_objs)
+			return None
+		frame_index += 1
+		if media_clock:
+			timestamp = media_timestamp(videoStream, frame_index, stream_start, stream_fps)
+		else:
+			timestamp = datetime.datetime.now()
+		return Frame(frame_index, image, timestamp)
+
+	def inference(frame):
+		"""
+		Inference stage: runs the detector over a frame, unless the cadence skips it or nothing moves.
+		Frames skipped by the cadence keep no detections, static frames get an empty array.
+		"""
+		if not cadence.detect():
+			return frame
+
+		# Without motion there is nothing new to detect. The tracker still needs a frame with no detections, so the tracks age.
+		if motion_gate is not None:
+			start = time.perf_counter()
+			moving = motion_gate.moving(frame.image)
+			metrics.observe("motion", time.perf_counter() - start)
+			if not moving:
+				frame.detections = np.empty((0, 6))
+				metrics.increment("frames_static")
+				return frame
+
+		frame.detections = detector.detect(frame.image)
+		for stage, seconds in detector.timings.items():
+			metrics.observe(stage, seconds)
+		return frame
+
+	pipeline.add_stage("capture", capture)
+	pipeline.add_stage("inference", inference)
+
+	# Time reference used to report the pipeline status.
+	processing_start = time.monotonic()
+	last_report = processing_start
+	last_stats = processing_start
+	frames_reported = 0
+
+	# The frames are tracked and counted in this thread until the stream ends or a SIGINT is received.
+	try:
+		if live_stream is not None:
+			live_stream.start()
+		pipeline.start()
+
+		for frame in pipeline:
+			# We are only intrested in some object classes, such as "car" or "truck". Their boxes, scores and classes are shared with the tracker.
+			start = time.perf_counter()
+			if frame.detections is not None:
+				detections = frame.detections[np.isin(frame.detections[:, 5], config["detector"]["classes"])]
+
+				# The tracker carries the class of each detection, so the tracks come back as [x1, y1, x2, y2, id, class, score].
+				trackers = tracker.update(detections)
 			else:
-				# Otherwise the tracker object requires an empty vector.
-				trackers = tracker.update(np.empty((0, 5)))
-			
-			# Having both the objects classes and their IDs, we need to match them. To do that, the euclidean distance is used.
-			if trackers.size != 0:
-				for track in trackers:
-					tracked_box = calculate_centroid(track[0], track[1], track[2], track[3])
-					for detected_obj in detected_objs:
-						detected_box = calculate_centroid(detected_obj[0], detected_obj[1], detected_obj[2], detected_obj[3])
-						distance = math.sqrt(pow(tracked_box[0] - detected_box[0], 2) + pow(tracked_box[1] - detected_box[1], 2))
-						if distance <= 10: # A maximum difference of 10 pixels is admitted between detections and tracks.
-							completed_objs = np.append(completed_objs, np.array([[track[0], track[1], track[2], track[3], track[4], detected_obj[4]]]), axis=0)
-				
-			# After matching the detections to the tracks, we send that information to the object counter.
-			objToSave = counter.update(completed_objs, config["result"]["verbose"])
-
-			# If there are objects to save, then we save them.
-			if(objToSave != None):
-				reporter.data_save(objToSave)
-				client.publish(config["mqtt"]["topic"], objToSave)
-								
-			# In case the user wants analyze the video output, then we show it.
-			if config["result"]["output"]:
-				draw_objects(frame, objs, labels)
-				if trackers.size != 0:
-					cv2.putText(frame, '%.2f' % (trackers[0, 4]), (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 1, cv2.LINE_AA)
-				
-				# A window for the video is opened.
-				cv2.imshow("Detections", frame)
-
-				# Each of the frames will be shown for at least 1 millisecond.
-				cv2.waitKey(1)
+				# Frames skipped by the detector are filled in with the positions predicted by the tracker.
+				trackers = tracker.coast()
+				metrics.increment("frames_predicted")
+			tracked = time.perf_counter()
+			metrics.observe("tracker", tracked - start)
+
+			# That information is sent to the object counter.
+			records = counter.update(trackers, config["result"]["verbose"], frame.index, frame.timestamp)
+			counted = time.perf_counter()
+			metrics.observe("counter", counted - tracked)
+
+			# If there are objects to save, then they are handed to the outputs.
+			if records:
+				for record in records:
+					bus.publish(record)
+				metrics.observe("publish", time.perf_counter() - counted)
+							
+			# In case the user wants analyze the video output, the frame is drawn on the render thread.
+			if renderer is not None:
+				renderer.submit(frame.image, frame.detections, trackers, frame.timestamp)
+
+			# The state of the pipeline is updated after each frame.
+			metrics.frame_done()
+			metrics.set("tracks_confirmed", len(trackers))
+			metrics.set("objects_tracked", len(counter.objects))
+			metrics.queue_depths = pipeline.queue_depths()
+			metrics.sinks = bus.stats()
+
+			# The lag of the pipeline sets how often the detector runs.
+			cadence.update(time.monotonic() - frame.captured)
+			metrics.set("pipeline_lag_seconds", cadence.lag)
+			metrics.set("detection_interval", cadence.interval)
+
+			# A snapshot of the tracker and the counter is saved every few seconds, in this thread, so both are consistent.
+			if checkpoint is not None and checkpoint.due():
+				start = time.perf_counter()
+				checkpoint.save(tracker, counter)
+				metrics.observe("checkpoint", time.perf_counter() - start)
+
+			# A summary of the metrics is periodically published, if a topic was given.
+			if config["metrics"]["topic"] and time.monotonic() - last_stats >= config["metrics"]["interval"]:
+				client.publish(config["metrics"]["topic"], json.dumps(metrics.stats()), qos = 0)
+				last_stats = time.monotonic()
+
+			# From time to time, the throughput and the depth of each queue are shown.
+			frames_reported += 1
+			elapsed = time.monotonic() - last_report
+			if config["result"]["verbose"] and elapsed >= config["pipeline"]["report_interval"]:
+				depths = ", ".join(name + "=" + str(depth) for name, depth in metrics.queue_depths.items())
+				print("[DEBUG]   FPS: %.2f, Queue depths: %s" % (frames_reported / elapsed, depths))
+				last_report = time.monotonic()
+				frames_reported = 0
+
+		# At the end of a recorded video, the vehicles still in sight are reported too. A live stream is only
+		# stopped by a restart, which carries them on through the checkpoint instead.
+		if offline:
+			for record in counter.drain():
+				bus.publish(record)
 
 	except KeyboardInterrupt:
-		# Clean up
-		cv2.destroyAllWindows()
-		videoStream.release()
+		print("[INFO]    SIGINT received.")
+
+	finally:
+		# Clean up. The stages are stopped before the video stream is released.
+		if live_stream is not None:
+			live_stream.stop()
+		stopped = pipeline.stop()
+		if renderer is not None:
+			renderer.stop()
+		# The stream cannot be released while the capture stage may still be reading from it.
+		if live_stream is None:
+			if stopped:
+				videoStream.release()
+			else:
+				print("[WARNING] The pipeline stages did not stop in time. The video stream is not released.")
+		# The last snapshot is saved once no more frames are tracked.
+		if checkpoint is not None:
+			try:
+				checkpoint.save(tracker, counter, clean = True)
+			except Exception as e:
+				print("[ERROR]   Could not save the checkpoint:", e)
+		# The records still queued are output before the reporter and the client are closed.
+		bus.close()
+		reporter.close()
 		client.disconnect()
+		if metrics_server is not None:
+			metrics_server.stop()
+
+		# In offline mode, it is useful to know how much faster than real time the video was processed.
+		elapsed = time.monotonic() - processing_start
+		if offline and frame_index > 0 and elapsed > 0 and stream_fps > 0:
+			print("[INFO]    Processed %d frames in %.1f s (%.2f FPS, %.1fx real time)." % (frame_index, elapsed, frame_index / elapsed, frame_index / stream_fps / elapsed))
 		print("[INFO]    Exiting gracefully. Bye!")
 	
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import csv
+import datetime
+import sqlite3
+import sys
+import yaml
+
+from reporter.database import query, count
+from reporter.reporter import field_names, format_record
+
+
+def main():
+	"""
+	Queries the vehicles saved to the database.
+	"""
+	parser = argparse.ArgumentParser(description = "Open Traffic Detector database query.")
+	parser.add_argument("-c", "--config", default = "./config.yml", help = "Configuration file, used to find the database.")
+	parser.add_argument("-d", "--database", default = None, help = "Database file. Overrides the configuration file.")
+	parser.add_argument("--from", dest = "start", type = datetime.datetime.fromisoformat, help = "Start time, e.g. '2021-05-12 08:00'.")
+	parser.add_argument("--to", dest = "end", type = datetime.datetime.fromisoformat, help = "End time, not included.")
+	parser.add_argument("--direction", type = int, choices = (1, 2), help = "1 for left to right (----->), 2 for right to left (<-----).")
+	parser.add_argument("--class", dest = "object_class", type = int, help = "Label ID of the vehicles.")
+	parser.add_argument("--min-speed", type = float, help = "Minimum speed in km/h.")
+	parser.add_argument("--max-speed", type = float, help = "Maximum speed in km/h.")
+	parser.add_argument("--limit", type = int, help = "Maximum number of vehicles returned.")
+	parser.add_argument("--count", action = "store_true", help = "Only show how many vehicles were found.")
+	args = parser.parse_args()
+
+	database = args.database or yaml.safe_load(open(args.config))["result"]["database"]
+	try:
+		if args.count:
+			print(count(database, args.start, args.end, args.direction, args.object_class, args.min_speed, args.max_speed, args.limit))
+			return
+		vehicles = query(database, args.start, args.end, args.direction, args.object_class, args.min_speed, args.max_speed, args.limit)
+	except sqlite3.DatabaseError as e:
+		# The database is opened read-only, so a missing or broken file is not created again.
+		print("[ERROR]   The database could not be opened: %s: %s" % (database, e), file = sys.stderr)
+		sys.exit(1)
+
+	# The vehicles are written as CSV, so the output can be saved or piped to other tools.
+	writer = csv.DictWriter(sys.stdout, fieldnames = field_names)
+	writer.writeheader()
+	for vehicle in vehicles:
+		writer.writerow(format_record(vehicle))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,49 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import yaml
+
+from supervisor.supervisor import Supervisor
+
+
+def main():
+	"""
+	Processes several cameras at once, with a decode worker process per camera and a single model.
+	"""
+	parser = argparse.ArgumentParser(description = "Open Traffic Detector supervisor of several cameras.")
+	parser.add_argument("-c", "--config", default = "./config.yml", help = "Configuration file.")
+	args = parser.parse_args()
+
+	# The configuration file is read. The content of the YAML file is loaded into a dictionary.
+	config = yaml.safe_load(open(args.config))
+	if not config["supervisor"]["cameras"]:
+		print("[ERROR]   No cameras were given in the configuration file.")
+		return
+
+	supervisor = Supervisor(config)
+	try:
+		supervisor.run()
+	except KeyboardInterrupt:
+		print("[INFO]    SIGINT received.")
+	finally:
+		supervisor.stop()
+		print("[INFO]    Exiting gracefully. Bye!")
+
+if __name__ == '__main__':
+	main()
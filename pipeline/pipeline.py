@@ -0,0 +1,220 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+import time
+
+# Seconds a stage waits on a queue before checking again if it has to stop.
+poll_interval = 0.1
+
+class Frame(object):
+	"""
+	This class represents a video frame travelling through the pipeline.
+	"""
+	def __init__(self, index, image, timestamp = None):
+		self.index = index
+		self.image = image
+		self.timestamp = timestamp
+		self.detections = None
+		# Monotonic time at which the frame was decoded, used to measure the lag of the pipeline.
+		self.captured = time.monotonic()
+
+
+class Cadence(object):
+	"""
+	This class decides which frames are run through the detector: one out of every interval frames.
+	The tracker predicts the position of the vehicles in the frames in between. When adaptive, the
+	interval grows while the pipeline lags behind the stream and shrinks again once it has caught up.
+	"""
+	# Weight of the newest lag sample in its moving average.
+	smoothing = 0.1
+
+	# Frames to wait after a change of the interval, so the queues settle before the next one.
+	settle_frames = 25
+
+	def __init__(self, interval = 1, max_interval = 1, target_lag = 0.5, adaptive = False):
+		self.min_interval = max(1, int(interval))
+		self.max_interval = max(self.min_interval, int(max_interval))
+		self.interval = self.min_interval
+		self.target_lag = target_lag
+		self.adaptive = adaptive
+		self.lag = 0.0
+		self.count = 0
+		self.frames_since_change = 0
+
+
+	def detect(self):
+		"""
+		Returns True if the next frame has to go through the detector. Called from the inference stage.
+		"""
+		detect = self.count == 0
+		self.count += 1
+		if self.count >= self.interval:
+			self.count = 0
+		return detect
+
+
+	def update(self, lag):
+		"""
+		Adds the time a frame took from being decoded to being counted, and adjusts the interval if needed.
+		"""
+		self.lag += self.smoothing * (lag - self.lag)
+		self.frames_since_change += 1
+		if not self.adaptive or self.frames_since_change < self.settle_frames:
+			return
+
+		if self.lag > self.target_lag and self.interval < self.max_interval:
+			self.interval += 1
+		elif self.lag < self.target_lag / 2 and self.interval > self.min_interval:
+			self.interval -= 1
+		else:
+			return
+		self.frames_since_change = 0
+		print("[INFO]    Pipeline lag of %.0f ms. Running the detector every %d frames." % (self.lag * 1000, self.interval))
+
+
+class Stage(threading.Thread):
+	"""
+	This class runs a single pipeline stage on its own thread.
+	"""
+	def __init__(self, name, work, input_queue, output_queue, stop_event):
+		super().__init__(name = name, daemon = True)
+		self.work = work
+		self.input_queue = input_queue
+		self.output_queue = output_queue
+		self.stop_event = stop_event
+		self.processed = 0
+
+
+	def get(self):
+		"""
+		Waits for the next item of the input queue. Returns None if the stage has to stop.
+		"""
+		while not self.stop_event.is_set():
+			try:
+				return self.input_queue.get(timeout = poll_interval)
+			except queue.Empty:
+				continue
+		return None
+
+
+	def put(self, item):
+		"""
+		Waits until there is room in the output queue. This is what makes the queues bounded.
+		"""
+		while not self.stop_event.is_set():
+			try:
+				self.output_queue.put(item, timeout = poll_interval)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+
+	def run(self):
+		"""
+		Processes items until the end of the stream (None) is found or the pipeline is stopped.
+		"""
+		try:
+			while not self.stop_event.is_set():
+				# The first stage has no input queue, so it produces the items by itself.
+				if self.input_queue is None:
+					item = self.work()
+				else:
+					item = self.get()
+					if item is not None:
+						item = self.work(item)
+
+				if item is None:
+					break
+
+				self.processed += 1
+				if not self.put(item):
+					break
+
+		except Exception as e:
+			print("[ERROR]   Pipeline stage '" + self.name + "' failed:", e)
+
+		finally:
+			# The end of the stream is always forwarded so the next stage finishes too.
+			self.put(None)
+
+
+class Pipeline(object):
+	"""
+	This class chains several stages together using bounded queues. As each stage has a single
+	thread and the queues are FIFO, frames always leave the pipeline in the order they entered it.
+	"""
+	def __init__(self, queue_size = 4):
+		self.queue_size = queue_size
+		self.stop_event = threading.Event()
+		self.stages = []
+		self.queues = {}
+		self.output_queue = None
+
+
+	def add_stage(self, name, work):
+		"""
+		Appends a new stage. The first stage added works as the source of the pipeline.
+		"""
+		output_queue = queue.Queue(maxsize = self.queue_size)
+		stage = Stage(name, work, self.output_queue, output_queue, self.stop_event)
+		self.stages.append(stage)
+		self.queues[name] = output_queue
+		self.output_queue = output_queue
+
+
+	def start(self):
+		"""
+		Starts all the stages.
+		"""
+		for stage in self.stages:
+			stage.start()
+
+
+	def __iter__(self):
+		"""
+		Yields the output of the last stage until the end of the stream.
+		"""
+		while not self.stop_event.is_set():
+			try:
+				item = self.output_queue.get(timeout = poll_interval)
+			except queue.Empty:
+				continue
+			if item is None:
+				break
+			yield item
+
+
+	def queue_depths(self):
+		"""
+		Returns how many items are waiting at the output of each stage.
+		"""
+		return {name: q.qsize() for name, q in self.queues.items()}
+
+
+	def stop(self, timeout = 2.0):
+		"""
+		Signals all the stages to stop and waits for them. Returns whether every stage has exited.
+		"""
+		self.stop_event.set()
+		for stage in self.stages:
+			if stage.is_alive():
+				stage.join(timeout)
+		return not any(stage.is_alive() for stage in self.stages)
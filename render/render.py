@@ -0,0 +1,289 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import threading
+import time
+import cv2
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.utils import draw_objects, draw_tracks
+
+# Seconds the render thread waits for a frame before checking again if it has to stop.
+poll_interval = 0.1
+
+# Boundary between the images of the MJPEG stream.
+boundary = "frame"
+
+# Longest gap, in seconds, filled in the recording by repeating the last frame. After a longer one, such as
+# a reconnection, the recording carries on from the next frame instead.
+max_gap = 5.0
+
+class PreviewServer(object):
+	"""
+	This class serves the annotated frames over HTTP on its own thread: as a MJPEG stream at /stream, which any
+	browser can show, and as a single image at /snapshot.jpg. Frames are only encoded up to max_fps times per second.
+	"""
+	def __init__(self, host = "127.0.0.1", port = 8090, max_fps = 5, quality = 70, width = 640):
+		self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+		self.quality = int(quality)
+		self.width = int(width)
+		self.jpeg = None
+		self.sequence = 0
+		self.last_encoded = 0.0
+		self.condition = threading.Condition()
+		self.stopped = False
+		preview = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler):
+				path = handler.path.split("?")[0]
+				if path == "/snapshot.jpg":
+					with preview.condition:
+						preview.condition.wait_for(lambda: preview.jpeg is not None or preview.stopped, timeout = 5.0)
+						jpeg = preview.jpeg
+					if jpeg is None:
+						handler.send_error(503)
+						return
+					handler.send_response(200)
+					handler.send_header("Content-Type", "image/jpeg")
+					handler.send_header("Content-Length", str(len(jpeg)))
+					handler.end_headers()
+					handler.wfile.write(jpeg)
+				elif path == "/stream":
+					handler.send_response(200)
+					handler.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + boundary)
+					handler.end_headers()
+					sequence = -1
+					try:
+						while True:
+							# Each new image is sent once, as soon as it is encoded.
+							with preview.condition:
+								preview.condition.wait_for(lambda: preview.sequence != sequence or preview.stopped)
+								if preview.stopped:
+									break
+								jpeg, sequence = preview.jpeg, preview.sequence
+							handler.wfile.write(("--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % (boundary, len(jpeg))).encode())
+							handler.wfile.write(jpeg)
+							handler.wfile.write(b"\r\n")
+					except (BrokenPipeError, ConnectionResetError):
+						# The viewer went away.
+						pass
+				else:
+					handler.send_error(404)
+
+			def log_message(handler, format, *args):
+				# Every request would be printed otherwise.
+				pass
+
+		self.server = ThreadingHTTPServer((host, port), Handler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target = self.server.serve_forever, name = "preview", daemon = True)
+		self.thread.start()
+		print("[INFO]    Preview available at: http://%s:%d/stream" % (host, port))
+
+
+	def due(self):
+		"""
+		Returns True if enough time has passed since the last image was encoded.
+		"""
+		return time.monotonic() - self.last_encoded >= self.interval
+
+
+	def publish(self, image):
+		"""
+		Encodes an image as JPEG, shrunk to the preview width, and hands it to the viewers.
+		"""
+		self.last_encoded = time.monotonic()
+		height, width = image.shape[:2]
+		if self.width and width > self.width:
+			image = cv2.resize(image, (self.width, int(height * self.width / width)), interpolation = cv2.INTER_AREA)
+		ok, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+		if not ok:
+			return
+		with self.condition:
+			self.jpeg = jpeg.tobytes()
+			self.sequence += 1
+			self.condition.notify_all()
+
+
+	def stop(self):
+		"""
+		Disconnects the viewers and stops the HTTP server.
+		"""
+		with self.condition:
+			self.stopped = True
+			self.condition.notify_all()
+		self.server.shutdown()
+		self.server.server_close()
+
+
+class Recorder(object):
+	"""
+	This class saves the annotated frames to a video file, shrunk by a scale factor. The file is opened with
+	the first frame, once its size is known. Frames are placed by their capture time, so the video plays in real
+	time even when some frames were skipped: the last frame is repeated to fill the gaps.
+	"""
+	def __init__(self, path, fps, scale = 0.5, codec = "mp4v"):
+		self.path = path
+		self.fps = fps if fps and fps > 0 else 25.0
+		self.scale = scale
+		self.codec = codec
+		self.writer = None
+		self.failed = False
+		self.start = None
+		self.frames = 0
+
+
+	def write(self, image, timestamp = None):
+		"""
+		Appends a frame to the video file, captured at the given time.
+		"""
+		if self.failed:
+			return
+		# Number of times the frame is written: enough to reach its place in the video, or none if it is early.
+		count = 1
+		if timestamp is not None:
+			if self.start is None:
+				self.start = timestamp
+			position = round((timestamp - self.start).total_seconds() * self.fps)
+			count = position - self.frames + 1
+			if count > max_gap * self.fps or position < 0:
+				self.start = timestamp - datetime.timedelta(seconds = self.frames / self.fps)
+				count = 1
+			if count <= 0:
+				return
+		if self.scale != 1:
+			image = cv2.resize(image, None, fx = self.scale, fy = self.scale, interpolation = cv2.INTER_AREA)
+		if self.writer is None:
+			height, width = image.shape[:2]
+			self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.codec), self.fps, (width, height))
+			if not self.writer.isOpened():
+				print("[ERROR]   The video file could not be opened for writing:", self.path)
+				self.failed = True
+				return
+			print("[INFO]    Recording the annotated video to:", self.path)
+		for i in range(count):
+			self.writer.write(image)
+		self.frames += count
+
+
+	def close(self):
+		"""
+		Finishes the video file.
+		"""
+		if self.writer is not None:
+			self.writer.release()
+
+
+class Renderer(threading.Thread):
+	"""
+	This class draws the detections and the tracks on the frames, away from the frame loop, and sends them to a
+	window, the preview server and a recorder. Only the newest frame is kept: if drawing falls behind, the frames
+	in between are skipped instead of slowing down the counting.
+	"""
+	def __init__(self, labels, regions = None, window = False, preview = None, recorder = None, metrics = None):
+		super().__init__(name = "render", daemon = True)
+		self.labels = labels
+		self.regions = regions or []
+		self.window = window
+		self.preview = preview
+		self.recorder = recorder
+		self.metrics = metrics
+		self.pending = None
+		self.condition = threading.Condition()
+		self.stop_event = threading.Event()
+		self.skipped = 0
+
+
+	def submit(self, image, detections, tracks, timestamp = None):
+		"""
+		Hands a frame, captured at the given time, to the render thread, replacing the one waiting if it was not
+		drawn yet. The image is drawn on, so it must not be used by the caller afterwards.
+		"""
+		with self.condition:
+			if self.pending is not None:
+				self.skipped += 1
+				if self.metrics is not None:
+					self.metrics.increment("frames_not_rendered")
+			self.pending = (image, detections, tracks, timestamp)
+			self.condition.notify()
+
+
+	def render(self, image, detections, tracks, timestamp = None):
+		"""
+		Draws a frame and sends it to the outputs.
+		"""
+		for x1, y1, x2, y2 in self.regions:
+			cv2.rectangle(image, (x1, y1), (x2, y2), (255, 0, 0), 1)
+		if detections is not None:
+			draw_objects(image, detections, self.labels)
+		draw_tracks(image, tracks)
+
+		if self.window:
+			# A window for the video is opened. Each of the frames will be shown for at least 1 millisecond.
+			try:
+				cv2.imshow("Detections", image)
+				cv2.waitKey(1)
+			except cv2.error:
+				# There is no display, or OpenCV was built without GUI support. The other outputs still work.
+				print("[WARNING] The video output cannot be shown on this system. Disabling it.")
+				self.window = False
+		if self.preview is not None and self.preview.due():
+			self.preview.publish(image)
+		if self.recorder is not None:
+			self.recorder.write(image, timestamp)
+
+
+	def run(self):
+		"""
+		Render thread: draws the newest frame until the renderer is stopped.
+		"""
+		try:
+			while True:
+				with self.condition:
+					self.condition.wait_for(lambda: self.pending is not None or self.stop_event.is_set(), timeout = poll_interval)
+					if self.pending is None:
+						if self.stop_event.is_set():
+							break
+						continue
+					item, self.pending = self.pending, None
+				start = time.perf_counter()
+				try:
+					self.render(*item)
+				except Exception as e:
+					print("[ERROR]   The frame could not be rendered:", e)
+				if self.metrics is not None:
+					self.metrics.observe("render", time.perf_counter() - start)
+		finally:
+			if self.window:
+				cv2.destroyAllWindows()
+			if self.recorder is not None:
+				self.recorder.close()
+
+
+	def stop(self, timeout = 5.0):
+		"""
+		Draws the last frame, closes the window and the recording, and stops the thread.
+		"""
+		self.stop_event.set()
+		with self.condition:
+			self.condition.notify()
+		self.join(timeout)
+		if self.preview is not None:
+			self.preview.stop()
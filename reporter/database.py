@@ -0,0 +1,170 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import sqlite3
+
+from reporter.reporter import Reporter
+
+schema = """
+CREATE TABLE IF NOT EXISTS vehicles (
+	id INTEGER PRIMARY KEY,
+	object_id INTEGER NOT NULL,
+	timestamp REAL NOT NULL,
+	x INTEGER,
+	y INTEGER,
+	direction INTEGER NOT NULL,
+	speed REAL NOT NULL,
+	class INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vehicles_timestamp ON vehicles (timestamp);
+CREATE INDEX IF NOT EXISTS vehicles_direction ON vehicles (direction, timestamp);
+CREATE INDEX IF NOT EXISTS vehicles_class ON vehicles (class, timestamp);
+"""
+
+insert = "INSERT INTO vehicles (object_id, timestamp, x, y, direction, speed, class) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+def connect(database):
+	"""
+	Opens the database in WAL mode, so it can be queried while records are being written.
+	"""
+	connection = sqlite3.connect(database, check_same_thread = False)
+	connection.execute("PRAGMA journal_mode=WAL")
+	connection.executescript(schema)
+	return connection
+
+
+class DatabaseReporter(Reporter):
+	"""
+	This class saves the records as typed rows of an SQLite database, in one transaction per batch.
+	"""
+	def __init__(self, database, buffer_size = 50, flush_interval = 5.0, fsync = False):
+		self.database = database
+		super().__init__(None, buffer_size, flush_interval, fsync)
+
+
+	def open_file(self):
+		"""
+		Opens the database. The same database is used across restarts.
+		"""
+		self.connection = connect(self.database)
+
+		# In WAL mode, NORMAL only syncs the disk at checkpoints, which is enough to keep the database consistent.
+		self.connection.execute("PRAGMA synchronous=" + ("FULL" if self.fsync else "NORMAL"))
+		self.full_path = self.database
+		print("[INFO]    Saving records to the database:", self.database)
+
+
+	def must_rotate(self):
+		"""
+		Databases are never rotated. Old records can be found quickly through the indexes.
+		"""
+		return False
+
+
+	def write_rows(self, rows):
+		"""
+		Inserts a batch of records in a single transaction.
+		"""
+		with self.connection:
+			self.connection.executemany(insert, [(row["id"], row["timestamp"].timestamp(), row["position"][0], row["position"][1],
+				row["direction"], row["speed"], row["class"]) for row in rows])
+
+
+	def close_file(self):
+		"""
+		Closes the database.
+		"""
+		self.connection.close()
+
+
+def connect_read_only(database):
+	"""
+	Opens the database only to read it. The schema is not touched, so it can be queried while it is being written.
+	"""
+	return sqlite3.connect("file:%s?mode=ro" % (database), uri = True)
+
+
+def where_clause(start = None, end = None, direction = None, object_class = None, min_speed = None, max_speed = None):
+	"""
+	Returns the WHERE clause that matches all the given conditions, and its parameters.
+	"""
+	conditions = []
+	parameters = []
+	if start is not None:
+		conditions.append("timestamp >= ?")
+		parameters.append(start.timestamp())
+	if end is not None:
+		conditions.append("timestamp < ?")
+		parameters.append(end.timestamp())
+	if direction is not None:
+		conditions.append("direction = ?")
+		parameters.append(direction)
+	if object_class is not None:
+		conditions.append("class = ?")
+		parameters.append(object_class)
+	if min_speed is not None:
+		conditions.append("speed >= ?")
+		parameters.append(min_speed)
+	if max_speed is not None:
+		conditions.append("speed <= ?")
+		parameters.append(max_speed)
+	return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+
+def query(database, start = None, end = None, direction = None, object_class = None, min_speed = None, max_speed = None, limit = None):
+	"""
+	Returns the vehicles that match all the given conditions, sorted by time. The start and end are datetime objects.
+	"""
+	where, parameters = where_clause(start, end, direction, object_class, min_speed, max_speed)
+	sql = "SELECT object_id, timestamp, x, y, direction, speed, class FROM vehicles" + where + " ORDER BY timestamp"
+	if limit is not None:
+		sql += " LIMIT ?"
+		parameters.append(limit)
+
+	connection = connect_read_only(database)
+	try:
+		rows = connection.execute(sql, parameters).fetchall()
+	finally:
+		connection.close()
+
+	return [{
+		"id": object_id,
+		"position": (x, y),
+		"timestamp": datetime.datetime.fromtimestamp(timestamp),
+		"direction": direction,
+		"speed": speed,
+		"class": object_class
+		} for object_id, timestamp, x, y, direction, speed, object_class in rows]
+
+
+def count(database, start = None, end = None, direction = None, object_class = None, min_speed = None, max_speed = None, limit = None):
+	"""
+	Returns how many vehicles match all the given conditions, counted by the database, up to the limit if one is given.
+	"""
+	where, parameters = where_clause(start, end, direction, object_class, min_speed, max_speed)
+	sql = "SELECT COUNT(*) FROM vehicles" + where
+	if limit is not None:
+		sql = "SELECT COUNT(*) FROM (SELECT 1 FROM vehicles" + where + " LIMIT ?)"
+		parameters.append(limit)
+
+	connection = connect_read_only(database)
+	try:
+		return connection.execute(sql, parameters).fetchone()[0]
+	finally:
+		connection.close()
@@ -18,27 +18,159 @@
 
 import datetime
 import csv
+import os
+import threading
 
 field_names = ["id", "position", "timestamp", "direction", "speed", "class"]
 
+# Records kept in memory while they cannot be written. Beyond this, the oldest ones are dropped.
+max_pending_records = 10000
+
+timestamp_format = '%d/%m/%Y %H:%M:%S'
+
+def format_record(record):
+	"""
+	Converts a record into the text representation used by the log files.
+	"""
+	row = {name: str(record[name]) for name in field_names}
+	row["timestamp"] = record["timestamp"].strftime(timestamp_format)
+	return row
+
+
 class Reporter():
 	"""
-	This class is used to report and log data.
+	This class is used to report and log data. Records are kept in memory and written by a background
+	thread, so the frame-processing thread never waits for the disk. Other outputs can subclass it and
+	override open_file, write_rows, close_file and must_rotate.
 	"""
-	def __init__(self, path):
+	def __init__(self, path, buffer_size = 50, flush_interval = 5.0, fsync = False, rotate_size = 0, rotate_daily = False):
 		self.path = path
-		self.filename = datetime.datetime.now().strftime('%d-%m-%Y-%H-%M-%S')
-		self.full_path = self.path + self.filename + ".csv"
+		self.buffer_size = buffer_size
+		self.flush_interval = flush_interval
+		self.fsync = fsync
+		self.rotate_size = rotate_size
+		self.rotate_daily = rotate_daily
 		self.files_reported = 0
+		self.buffer = []
+		self.lock = threading.Lock()
+		self.flush_event = threading.Event()
+		self.stop_event = threading.Event()
+
+		# The first file is created right away, so a wrong path is found at startup.
+		self.open_file()
+
+		self.thread = threading.Thread(target = self.run, name = "reporter", daemon = True)
+		self.thread.start()
+
+
+	def open_file(self):
+		"""
+		Creates a new file named by the current time and writes its header.
+		"""
+		self.opened = datetime.datetime.now()
+		self.filename = self.opened.strftime('%d-%m-%Y-%H-%M-%S')
+		self.full_path = self.path + self.filename + ".csv"
+
+		# Files rotated within the same second get a suffix.
+		suffix = 1
+		while os.path.exists(self.full_path):
+			self.full_path = self.path + self.filename + "-" + str(suffix) + ".csv"
+			suffix += 1
 
-		with open(self.full_path, 'w', newline='') as outcsv:
-			writer = csv.DictWriter(outcsv, fieldnames = field_names) 
-			writer.writeheader()
-		outcsv.close()
+		self.outcsv = open(self.full_path, 'w', newline='')
+		self.writer = csv.DictWriter(self.outcsv, fieldnames = field_names)
+		self.writer.writeheader()
+		self.outcsv.flush()
+		self.files_reported += 1
 		print("[INFO]    The following file has been created.:", self.full_path)
 
 
+	def must_rotate(self):
+		"""
+		Checks if the current file is too big or from a previous day.
+		"""
+		if self.rotate_size and self.outcsv.tell() >= self.rotate_size:
+			return True
+		if self.rotate_daily and datetime.date.today() != self.opened.date():
+			return True
+		return False
+
+
 	def data_save(self, dataToSave):
-		with open(self.full_path, 'a') as outcsv:
-			writer = csv.DictWriter(outcsv, fieldnames = field_names)
-			writer.writerow(dataToSave)
\ No newline at end of file
+		"""
+		Queues a record to be written. The writer thread is woken up when the buffer is full.
+		"""
+		with self.lock:
+			self.buffer.append(dataToSave)
+			full = len(self.buffer) >= self.buffer_size
+		if full:
+			self.flush_event.set()
+
+
+	def flush(self):
+		"""
+		Writes all the queued records to the file. Only called from the writer thread, or once it has stopped.
+		"""
+		with self.lock:
+			rows, self.buffer = self.buffer, []
+		if not rows:
+			return
+		try:
+			if self.must_rotate():
+				self.close_file()
+				self.open_file()
+			self.write_rows(rows)
+		except Exception:
+			# The records are put back in front of the newer ones, to be written with the next flush.
+			with self.lock:
+				self.buffer = rows + self.buffer
+				lost = len(self.buffer) - max_pending_records
+				if lost > 0:
+					del self.buffer[:lost]
+			if lost > 0:
+				print("[ERROR]   %d records could not be written and were dropped." % (lost))
+			raise
+
+
+	def write_rows(self, rows):
+		"""
+		Writes a batch of records to the current file.
+		"""
+		self.writer.writerows(format_record(row) for row in rows)
+		self.outcsv.flush()
+		if self.fsync:
+			os.fsync(self.outcsv.fileno())
+
+
+	def close_file(self):
+		"""
+		Closes the current file.
+		"""
+		self.outcsv.close()
+
+
+	def run(self):
+		"""
+		Writer thread: flushes the buffer when it is full or every flush interval.
+		"""
+		while not self.stop_event.is_set():
+			self.flush_event.wait(self.flush_interval)
+			self.flush_event.clear()
+			try:
+				self.flush()
+			except Exception as e:
+				print("[ERROR]   Could not write to the log file:", e)
+
+
+	def close(self):
+		"""
+		Stops the writer thread, drains the buffer and closes the file.
+		"""
+		self.stop_event.set()
+		self.flush_event.set()
+		self.thread.join()
+		try:
+			self.flush()
+		except Exception as e:
+			print("[ERROR]   Could not write to the log file, %d records were lost:" % (len(self.buffer)), e)
+		self.close_file()
@@ -0,0 +1,207 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import numpy as np
+
+from multiprocessing import shared_memory
+
+# Fields of the header, shared by the writer and the reader.
+WRITTEN, TAKEN, LATEST, READING, ENDED = range(5)
+HEARTBEAT = 0
+
+# Fields kept for each slot.
+INDEX, HEIGHT, WIDTH, MOVING = range(4)
+TIMESTAMP, CAPTURED, READ_SECONDS, MOTION_SECONDS = range(4)
+
+header_fields = 8
+slot_fields = 4
+
+class FrameRing(object):
+	"""
+	This class passes decoded frames from one process to another through a block of shared memory, so the frames
+	are never pickled or copied between processes. The memory holds a few slots, each big enough for the largest
+	frame allowed, and a small header. The writer decodes straight into a free slot and then publishes it; the
+	reader takes the newest published slot and keeps it until it takes the next one, so the writer never touches
+	a frame that is being read. A lock shared by both processes only guards the few header fields that say which
+	slot is which.
+	"""
+	def __init__(self, name, lock, slots = 3, max_width = 1920, max_height = 1080, create = False):
+		self.lock = lock
+		self.slots = slots
+		self.slot_size = max_width * max_height * 3
+		int_size = (header_fields + slots * slot_fields) * 8
+		size = 2 * int_size + slots * self.slot_size
+
+		if create:
+			self.memory = shared_memory.SharedMemory(name = name, create = True, size = size)
+		else:
+			# The writers are started by the process that created the memory and share its resource tracker,
+			# so the memory is not removed when a writer exits.
+			self.memory = shared_memory.SharedMemory(name = name)
+		self.created = create
+
+		self.ints = np.ndarray(header_fields + slots * slot_fields, dtype = np.int64, buffer = self.memory.buf)
+		self.floats = np.ndarray(header_fields + slots * slot_fields, dtype = np.float64, buffer = self.memory.buf, offset = int_size)
+		self.data = np.ndarray(slots * self.slot_size, dtype = np.uint8, buffer = self.memory.buf, offset = 2 * int_size)
+		if create:
+			self.ints[:] = 0
+			self.floats[:] = 0
+			self.ints[LATEST] = -1
+			self.ints[READING] = -1
+		self.next_slot = 0
+
+
+	@property
+	def name(self):
+		return self.memory.name
+
+
+	def slot_meta(self, slot):
+		"""
+		Returns the position of the fields of a slot in the header arrays.
+		"""
+		return header_fields + slot * slot_fields
+
+
+	def image(self, slot, height, width):
+		"""
+		Returns the frame of a slot as an image array, without copying it.
+		"""
+		return self.data[slot * self.slot_size:slot * self.slot_size + height * width * 3].reshape(height, width, 3)
+
+
+	def fits(self, height, width):
+		"""
+		Returns True if frames of this size fit in a slot.
+		"""
+		return height * width * 3 <= self.slot_size
+
+
+	def acquire(self):
+		"""
+		Writer side. Returns a slot that is neither the newest one nor the one being read, so it can be written.
+		"""
+		with self.lock:
+			busy = (self.ints[LATEST], self.ints[READING])
+			while self.next_slot in busy:
+				self.next_slot = (self.next_slot + 1) % self.slots
+			slot = self.next_slot
+		self.next_slot = (slot + 1) % self.slots
+		return slot
+
+
+	def publish(self, slot, index, height, width, timestamp, moving = True, read_seconds = 0.0, motion_seconds = 0.0):
+		"""
+		Writer side. Makes a written slot the newest frame.
+		"""
+		meta = self.slot_meta(slot)
+		with self.lock:
+			self.ints[meta + INDEX] = index
+			self.ints[meta + HEIGHT] = height
+			self.ints[meta + WIDTH] = width
+			self.ints[meta + MOVING] = moving
+			self.floats[meta + TIMESTAMP] = timestamp
+			self.floats[meta + CAPTURED] = time.monotonic()
+			self.floats[meta + READ_SECONDS] = read_seconds
+			self.floats[meta + MOTION_SECONDS] = motion_seconds
+			self.ints[LATEST] = slot
+			self.ints[WRITTEN] += 1
+			self.floats[HEARTBEAT] = time.monotonic()
+
+
+	def pending(self):
+		"""
+		Returns the number of published frames the reader has not taken yet.
+		"""
+		with self.lock:
+			return int(self.ints[WRITTEN] - self.ints[TAKEN])
+
+
+	def beat(self):
+		"""
+		Writer side. Tells the reader the writer is still alive while it has no frame to publish.
+		"""
+		self.floats[HEARTBEAT] = time.monotonic()
+
+
+	def end(self):
+		"""
+		Writer side. Tells the reader that no more frames will come.
+		"""
+		with self.lock:
+			self.ints[ENDED] = 1
+
+
+	def ended(self):
+		"""
+		Returns True if the writer ended the stream and every frame was taken.
+		"""
+		with self.lock:
+			return bool(self.ints[ENDED]) and self.ints[WRITTEN] == self.ints[TAKEN]
+
+
+	def heartbeat(self):
+		"""
+		Returns the monotonic time at which the writer was last heard of.
+		"""
+		return float(self.floats[HEARTBEAT])
+
+
+	def take(self):
+		"""
+		Reader side. Returns the newest frame as (index, image, timestamp, captured, moving, read seconds, motion seconds,
+		skipped), or None if there is no new one. The image stays valid until the next call. Skipped is the number
+		of frames published in between that were never taken.
+		"""
+		with self.lock:
+			written = self.ints[WRITTEN]
+			if written == self.ints[TAKEN]:
+				return None
+			skipped = int(written - self.ints[TAKEN] - 1)
+			slot = int(self.ints[LATEST])
+			self.ints[READING] = slot
+			self.ints[TAKEN] = written
+			meta = self.slot_meta(slot)
+			index, height, width, moving = (int(v) for v in self.ints[meta:meta + slot_fields])
+			timestamp, captured, read_seconds, motion_seconds = (float(v) for v in self.floats[meta:meta + slot_fields])
+		return index, self.image(slot, height, width), timestamp, captured, bool(moving), read_seconds, motion_seconds, skipped
+
+
+	def reset(self):
+		"""
+		Reader side. Forgets the state of a writer that died, before a new one is started.
+		"""
+		with self.lock:
+			self.ints[ENDED] = 0
+			self.ints[TAKEN] = self.ints[WRITTEN]
+			self.floats[HEARTBEAT] = time.monotonic()
+
+
+	def close(self):
+		"""
+		Detaches from the shared memory, and removes it if this process created it.
+		"""
+		self.ints = self.floats = self.data = None
+		try:
+			self.memory.close()
+		except BufferError:
+			# An image of the ring is still referenced. The memory is released when the process exits.
+			pass
+		if self.created:
+			self.memory.unlink()
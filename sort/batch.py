@@ -0,0 +1,271 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+	Based on: https://github.com/abewley/sort/blob/master/sort.py
+"""
+
+import numpy as np
+
+from sort.sort import associate_detections_to_trackers
+
+# Constant velocity model, the same one used by KalmanBoxTracker. The state is [x,y,s,r,x',y',s'].
+F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],[0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]], dtype=float)
+H = np.array([[1,0,0,0,0,0,0],[0,1,0,0,0,0,0],[0,0,1,0,0,0,0],[0,0,0,1,0,0,0]], dtype=float)
+
+# Measurement noise.
+R = np.eye(4)
+R[2:,2:] *= 10.
+
+# Process noise.
+Q = np.eye(7)
+Q[-1,-1] *= 0.01
+Q[4:,4:] *= 0.01
+
+# Initial covariance. High uncertainty is given to the unobservable initial velocities.
+P0 = np.eye(7)
+P0[4:,4:] *= 1000.
+P0 *= 10.
+
+I7 = np.eye(7)
+
+
+def convert_bboxes_to_z(bboxes):
+	"""
+	Takes N bounding boxes in the form [x1,y1,x2,y2] and returns an (N, 4) array in the form [x,y,s,r].
+	"""
+	w = bboxes[:, 2] - bboxes[:, 0]
+	h = bboxes[:, 3] - bboxes[:, 1]
+	return np.stack((bboxes[:, 0] + w/2., bboxes[:, 1] + h/2., w * h, w / h), axis=1)
+
+
+def convert_x_to_bboxes(x):
+	"""
+	Takes N states in the form [x,y,s,r,...] and returns an (N, 4) array in the form [x1,y1,x2,y2].
+	"""
+	w = np.sqrt(x[:, 2] * x[:, 3])
+	h = x[:, 2] / w
+	return np.stack((x[:, 0] - w/2., x[:, 1] - h/2., x[:, 0] + w/2., x[:, 1] + h/2.), axis=1)
+
+
+class BatchSort(object):
+	"""
+	Drop-in replacement for Sort that keeps every track in stacked arrays, so the Kalman
+	predict and update steps run once per frame for all the tracks instead of once per track.
+	"""
+	def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3):
+		"""
+		Sets key parameters for SORT
+		"""
+		self.max_age = max_age
+		self.min_hits = min_hits
+		self.iou_threshold = iou_threshold
+		self.frame_count = 0
+		self.count = 0
+
+		# Kalman filter state and covariance of each track.
+		self.x = np.zeros((0, 7))
+		self.P = np.zeros((0, 7, 7))
+
+		# Bookkeeping of each track, as in KalmanBoxTracker.
+		self.ids = np.zeros(0, dtype=int)
+		self.attributes = np.zeros((0, 1))
+		self.time_since_update = np.zeros(0, dtype=int)
+		self.hits = np.zeros(0, dtype=int)
+		self.hit_streak = np.zeros(0, dtype=int)
+		self.age = np.zeros(0, dtype=int)
+
+
+	def __len__(self):
+		return len(self.ids)
+
+
+	def keep(self, mask):
+		"""
+		Keeps only the tracks selected by a boolean mask, preserving their order.
+		"""
+		self.x = self.x[mask]
+		self.P = self.P[mask]
+		self.ids = self.ids[mask]
+		self.attributes = self.attributes[mask]
+		self.time_since_update = self.time_since_update[mask]
+		self.hits = self.hits[mask]
+		self.hit_streak = self.hit_streak[mask]
+		self.age = self.age[mask]
+
+
+	def advance(self):
+		"""
+		Runs the Kalman prediction step for all the tracks.
+		"""
+		# The scale cannot become negative.
+		self.x[(self.x[:, 6] + self.x[:, 2]) <= 0, 6] = 0.
+		self.x = self.x @ F.T
+		self.P = F @ self.P @ F.T + Q
+
+
+	def predict(self):
+		"""
+		Advances the state of all the tracks and returns their predicted bounding boxes.
+		"""
+		self.advance()
+		self.age += 1
+		self.hit_streak[self.time_since_update > 0] = 0
+		self.time_since_update += 1
+		return convert_x_to_bboxes(self.x)
+
+
+	def correct(self, trks, bboxes):
+		"""
+		Updates the selected tracks with their observed bounding boxes, including the score and any extra attributes.
+		"""
+		x = self.x[trks]
+		P = self.P[trks]
+		y = convert_bboxes_to_z(bboxes[:, :4]) - x[:, :4]
+		PHT = P[:, :, :4]
+		S = PHT[:, :4, :] + R
+		K = PHT @ np.linalg.inv(S)
+		I_KH = I7 - K @ H
+		self.x[trks] = x + (K @ y[:, :, None])[:, :, 0]
+		self.P[trks] = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ R @ K.transpose(0, 2, 1)
+		self.attributes[trks] = bboxes[:, 4:]
+		self.time_since_update[trks] = 0
+		self.hits[trks] += 1
+		self.hit_streak[trks] += 1
+
+
+	def create(self, bboxes):
+		"""
+		Initialises a new track for each one of the bounding boxes, keeping the score and any extra attributes.
+		"""
+		n = len(bboxes)
+		x = np.zeros((n, 7))
+		x[:, :4] = convert_bboxes_to_z(bboxes[:, :4])
+		self.x = np.concatenate((self.x, x))
+		self.P = np.concatenate((self.P, np.broadcast_to(P0, (n, 7, 7))))
+		self.ids = np.concatenate((self.ids, np.arange(self.count, self.count + n)))
+		self.count += n
+		self.attributes = np.concatenate((self.attributes, bboxes[:, 4:]))
+		self.time_since_update = np.concatenate((self.time_since_update, np.zeros(n, dtype=int)))
+		self.hits = np.concatenate((self.hits, np.zeros(n, dtype=int)))
+		self.hit_streak = np.concatenate((self.hit_streak, np.zeros(n, dtype=int)))
+		self.age = np.concatenate((self.age, np.zeros(n, dtype=int)))
+
+
+	def report(self, extra, boxes = None):
+		"""
+		Returns the tracks updated in the last frame, in reverse order of creation as Sort does.
+		"""
+		if boxes is None:
+			boxes = convert_x_to_bboxes(self.x)
+		updated = self.time_since_update < 1
+		if self.frame_count > self.min_hits:
+			updated &= self.hit_streak >= self.min_hits
+		ret = np.concatenate((boxes[updated], self.ids[updated, None] + 1), axis=1)
+		if extra:
+			ret = np.concatenate((ret, np.roll(self.attributes[updated], -1, axis=1)), axis=1)
+		return ret[::-1]
+
+
+	def update(self, dets=np.empty((0, 5))):
+		"""
+		Params:
+			dets - a numpy array of detections in the format [[x1,y1,x2,y2,score],[x1,y1,x2,y2,score],...]
+		Required: this method must be called once for each frame even with empty detections (use np.empty((0, 5)) for frames without detections).
+		Returns a similar array, where the last column is the object ID. The output is the same as Sort.update,
+		including the extra detection columns, which are returned as [x1,y1,x2,y2,ID,extra...,score].
+		"""
+		self.frame_count += 1
+
+		# The attributes carried by the tracks take the width of the detections.
+		if len(self) == 0 and self.attributes.shape[1] != dets.shape[1] - 4:
+			self.attributes = np.zeros((0, dets.shape[1] - 4))
+
+		# get predicted locations from existing trackers and drop the invalid ones.
+		trks = self.predict()
+		valid = ~np.any(np.isnan(trks), axis=1)
+		if not valid.all():
+			self.keep(valid)
+			trks = trks[valid]
+		matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks, self.iou_threshold)
+
+		# update matched trackers with assigned detections
+		if len(matched) > 0:
+			self.correct(matched[:, 1], dets[matched[:, 0]])
+
+		# create and initialise new trackers for unmatched detections
+		if len(unmatched_dets) > 0:
+			self.create(dets[np.asarray(unmatched_dets, dtype=int)])
+
+		ret = self.report(dets.shape[1] > 5)
+
+		# remove dead tracklets
+		alive = self.time_since_update <= self.max_age
+		if not alive.all():
+			self.keep(alive)
+
+		if len(ret) > 0:
+			return ret
+		return np.empty((0, dets.shape[1] + 1 if dets.shape[1] > 5 else 5))
+
+
+	def coast(self):
+		"""
+		Advances all the tracks one frame without detections, for frames that were not run through the detector.
+		The output is the same as Sort.coast.
+		"""
+		self.advance()
+		boxes = convert_x_to_bboxes(self.x)
+		ret = self.report(self.attributes.shape[1] > 1, boxes)
+		ret = ret[~np.any(np.isnan(ret[:, :4]), axis=1)]
+		return ret
+
+
+	def state(self):
+		"""
+		Returns a snapshot of all the tracks as a dictionary of arrays, the same as Sort.state().
+		"""
+		return {
+			"frame_count": np.array(self.frame_count),
+			"count": np.array(self.count),
+			"x": self.x.copy(),
+			"P": self.P.copy(),
+			"ids": self.ids.copy(),
+			"attributes": self.attributes.copy(),
+			"time_since_update": self.time_since_update.copy(),
+			"hits": self.hits.copy(),
+			"hit_streak": self.hit_streak.copy(),
+			"age": self.age.copy(),
+		}
+
+
+	def restore(self, state, tracks=True):
+		"""
+		Loads a snapshot taken by state() of either backend. As in Sort.restore(), only the IDs are restored if tracks is False.
+		"""
+		self.count = max(self.count, int(state["count"]))
+		if not tracks:
+			self.keep(np.zeros(len(self), dtype=bool))
+			return
+		self.frame_count = int(state["frame_count"])
+		self.x = np.array(state["x"], dtype=float).reshape(-1, 7)
+		self.P = np.array(state["P"], dtype=float).reshape(-1, 7, 7)
+		self.ids = np.array(state["ids"], dtype=int)
+		self.attributes = np.array(state["attributes"], dtype=float)
+		self.time_since_update = np.array(state["time_since_update"], dtype=int)
+		self.hits = np.array(state["hits"], dtype=int)
+		self.hit_streak = np.array(state["hit_streak"], dtype=int)
+		self.age = np.array(state["age"], dtype=int)
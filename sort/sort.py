@@ -17,29 +17,27 @@
 """
 from __future__ import print_function
 
-import os
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from skimage import io
-
-import glob
-import time
-import argparse
-from filterpy.kalman import KalmanFilter
 
 np.random.seed(0)
 
+# Only numpy is imported with this module. filterpy and the assignment solver take seconds to import
+# on a Raspberry Pi, so they are imported the first time they are needed.
+lap = None
+linear_sum_assignment = None
+
 
 def linear_assignment(cost_matrix):
-	try:
-		import lap
+	global lap, linear_sum_assignment
+	if lap is None and linear_sum_assignment is None:
+		try:
+			import lap
+		except ImportError:
+			from scipy.optimize import linear_sum_assignment
+	if lap is not None:
 		_, x, y = lap.lapjv(cost_matrix, extend_cost=True)
 		return np.array([[y[i],i] for i in x if i >= 0]) #
-	except ImportError:
-		from scipy.optimize import linear_sum_assignment
+	else:
 		x, y = linear_sum_assignment(cost_matrix)
 		return np.array(list(zip(x, y)))
 
@@ -100,6 +98,8 @@ class KalmanBoxTracker(object):
 		"""
 		Initialises a tracker using initial bounding box.
 		"""
+		from filterpy.kalman import KalmanFilter
+
 		#define constant velocity model
 		self.kf = KalmanFilter(dim_x=7, dim_z=4) 
 		self.kf.F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],  [0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]])
@@ -112,6 +112,7 @@ class KalmanBoxTracker(object):
 		self.kf.Q[4:,4:] *= 0.01
 
 		self.kf.x[:4] = convert_bbox_to_z(bbox)
+		self.attributes = np.asarray(bbox[4:])
 		self.time_since_update = 0
 		self.id = KalmanBoxTracker.count
 		KalmanBoxTracker.count += 1
@@ -128,6 +129,7 @@ class KalmanBoxTracker(object):
 		self.history = []
 		self.hits += 1
 		self.hit_streak += 1
+		self.attributes = np.asarray(bbox[4:])
 		self.kf.update(convert_bbox_to_z(bbox))
 
 	def predict(self):
@@ -144,6 +146,15 @@ class KalmanBoxTracker(object):
 		self.history.append(convert_x_to_bbox(self.kf.x))
 		return self.history[-1]
 
+	def coast(self):
+		"""
+		Advances the state vector for a frame that was not run through the detector. It is not counted as a missed detection.
+		"""
+		if((self.kf.x[6]+self.kf.x[2])<=0):
+			self.kf.x[6] *= 0.0
+		self.kf.predict()
+		return self.get_state()
+
 	def get_state(self):
 		"""
 		Returns the current bounding box estimate.
@@ -206,6 +217,8 @@ class Sort(object):
 		self.iou_threshold = iou_threshold
 		self.trackers = []
 		self.frame_count = 0
+		# Number of columns of the output, kept so that an empty one has the same shape as the others.
+		self.width = 5
 
 	def update(self, dets=np.empty((0, 5))):
 		"""
@@ -214,6 +227,10 @@ class Sort(object):
 		Required: this method must be called once for each frame even with empty detections (use np.empty((0, 5)) for frames without detections).
 		Returns a similar array, where the last column is the object ID.
 
+		Detections may carry extra columns after the score, e.g. [x1,y1,x2,y2,score,class]. In that case they are
+		carried through the association step and each track is returned as [x1,y1,x2,y2,ID,extra...,score],
+		using the attributes of the detection matched in this frame.
+
 		NOTE: The number of objects returned may differ from the number of detections provided.
 		"""
 		self.frame_count += 1
@@ -239,15 +256,82 @@ class Sort(object):
 		for i in unmatched_dets:
 			trk = KalmanBoxTracker(dets[i,:])
 			self.trackers.append(trk)
+		extra = dets.shape[1] > 5
+		self.width = dets.shape[1] + 1 if extra else 5
 		i = len(self.trackers)
 		for trk in reversed(self.trackers):
 			d = trk.get_state()[0]
 			if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
-				ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1)) # +1 as MOT benchmark requires positive
+				if extra:
+					ret.append(np.concatenate((d,[trk.id+1],trk.attributes[1:],trk.attributes[:1])).reshape(1,-1))
+				else:
+					ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1)) # +1 as MOT benchmark requires positive
 			i -= 1
 			# remove dead tracklet
 			if(trk.time_since_update > self.max_age):
 				self.trackers.pop(i)
 		if(len(ret)>0):
 			return np.concatenate(ret)
-		return np.empty((0,5))
\ No newline at end of file
+		return np.empty((0,self.width))
+
+	def coast(self):
+		"""
+		Advances all the tracks one frame without detections, for frames that were not run through the detector.
+		Tracks are not aged, so they survive any number of skipped frames. Returns the tracks reported by the last
+		update at their predicted positions, in the same format, with the attributes of their last detection.
+		"""
+		ret = []
+		for trk in reversed(self.trackers):
+			d = trk.coast()[0]
+			if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits) and not np.any(np.isnan(d)):
+				if len(trk.attributes) > 1:
+					ret.append(np.concatenate((d,[trk.id+1],trk.attributes[1:],trk.attributes[:1])).reshape(1,-1))
+				else:
+					ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1))
+		if(len(ret)>0):
+			return np.concatenate(ret)
+		return np.empty((0,self.width))
+
+	def state(self):
+		"""
+		Returns a snapshot of all the tracks as a dictionary of arrays, in the same format as BatchSort, so it can be
+		saved and given back to restore() of either backend. It includes the next free ID.
+		"""
+		n = len(self.trackers)
+		k = len(self.trackers[0].attributes) if n else max(1, self.width - 5)
+		return {
+			"frame_count": np.array(self.frame_count),
+			"count": np.array(KalmanBoxTracker.count),
+			"x": np.array([trk.kf.x[:, 0] for trk in self.trackers]).reshape(n, 7),
+			"P": np.array([trk.kf.P for trk in self.trackers]).reshape(n, 7, 7),
+			"ids": np.array([trk.id for trk in self.trackers], dtype=int),
+			"attributes": np.array([trk.attributes for trk in self.trackers]).reshape(n, k),
+			"time_since_update": np.array([trk.time_since_update for trk in self.trackers], dtype=int),
+			"hits": np.array([trk.hits for trk in self.trackers], dtype=int),
+			"hit_streak": np.array([trk.hit_streak for trk in self.trackers], dtype=int),
+			"age": np.array([trk.age for trk in self.trackers], dtype=int),
+		}
+
+	def restore(self, state, tracks=True):
+		"""
+		Loads a snapshot taken by state(). New tracks never reuse an ID below the saved count. If tracks is False,
+		only the IDs are restored and the saved tracks are dropped.
+		"""
+		count = max(KalmanBoxTracker.count, int(state["count"]))
+		self.trackers = []
+		if tracks:
+			self.frame_count = int(state["frame_count"])
+			k = np.shape(state["attributes"])[1]
+			self.width = k + 5 if k > 1 else 5
+			for i in range(len(state["ids"])):
+				# The filter is built as usual and then its state is replaced by the saved one.
+				trk = KalmanBoxTracker(np.concatenate(([0., 0., 1., 1.], state["attributes"][i])))
+				trk.kf.x = state["x"][i].reshape(7, 1).copy()
+				trk.kf.P = state["P"][i].copy()
+				trk.id = int(state["ids"][i])
+				trk.time_since_update = int(state["time_since_update"][i])
+				trk.hits = int(state["hits"][i])
+				trk.hit_streak = int(state["hit_streak"][i])
+				trk.age = int(state["age"][i])
+				self.trackers.append(trk)
+		KalmanBoxTracker.count = count
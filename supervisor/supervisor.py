@@ -0,0 +1,386 @@
+"""
+	Open Traffic Detector: Simple and Realtime Traffic Monitor
+	Copyright (C) 2020-2021 - Agustin Curcio Berardi
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import copy
+import cv2
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+from sort.sort import Sort
+from sort.batch import BatchSort
+from tracker.tracker import ObjectCounter
+from calibration.calibration import create_calibration
+from checkpoint.checkpoint import create_checkpoint
+from detector.detector import load_detector, limit_to_regions
+from reporter.reporter import Reporter
+from reporter.database import DatabaseReporter
+from mqtt.mqtt import MqttClient
+from events.events import EventBus, ReporterSink, MqttSink, WebhookSink
+from motion.motion import MotionGate
+from metrics.metrics import Metrics, MetricsGroup, MetricsServer
+from ring.ring import FrameRing
+from utils.utils import open_stream, media_timestamp
+
+# Exit codes of a decode worker. A worker that lost its stream is started again, but not one that cannot work.
+EXIT_ENDED, EXIT_LOST, EXIT_FATAL = 0, 1, 2
+
+# Seconds the supervisor waits for a new frame before checking the workers again.
+poll_interval = 0.1
+
+def camera_config(config, camera):
+	"""
+	Returns the configuration of a camera: the main one, with the keys of each section given for the camera replaced.
+	The checkpoint of each camera is saved to its own file.
+	"""
+	config = copy.deepcopy(config)
+	for section, values in camera.items():
+		if isinstance(values, dict):
+			config[section].update(values)
+	config["input"]["source"] = camera["source"]
+	if config["checkpoint"]["path"]:
+		config["checkpoint"]["path"] = config["checkpoint"]["path"] + "-" + camera["name"]
+	return config
+
+
+def decode_worker(name, config, ring_name, lock, slots, max_width, max_height, ready, stop):
+	"""
+	Decodes the video stream of a camera straight into its ring buffer, and checks it for motion. Runs in its own process.
+	"""
+	ring = FrameRing(ring_name, lock, slots, max_width, max_height)
+	videoStream = open_stream(config["input"]["source"], config["input"]["width"], config["input"]["height"])
+	if not videoStream.isOpened():
+		print("[ERROR]   %s: The video stream could not be opened." % (name))
+		ring.close()
+		sys.exit(EXIT_LOST)
+
+	# Recorded videos are read without dropping any frame, and their time is taken from the video itself.
+	offline = config["input"]["offline"]
+	fps = videoStream.get(cv2.CAP_PROP_FPS)
+	stream_start = datetime.datetime.now()
+	motion_gate = None
+	if config["motion"]["enabled"]:
+		motion_gate = MotionGate(config["detector"]["regions"], config["motion"]["width"], config["motion"]["threshold"],
+			config["motion"]["min_area"], config["motion"]["hold_frames"])
+
+	shape = None
+	frame_index = 0
+	try:
+		while not stop.is_set():
+			slot = ring.acquire()
+			view = ring.image(slot, *shape) if shape is not None else None
+			start = time.perf_counter()
+			ret, image = videoStream.read(view)
+			read_seconds = time.perf_counter() - start
+			if not ret:
+				if offline:
+					ring.end()
+					ready.set()
+					sys.exit(EXIT_ENDED)
+				print("[ERROR]   %s: The video frame could not be read." % (name))
+				sys.exit(EXIT_LOST)
+
+			# OpenCV decodes into the slot, unless it is the first frame or its size changed.
+			if view is None or image.ctypes.data != view.ctypes.data:
+				if not ring.fits(*image.shape[:2]):
+					print("[ERROR]   %s: Frames of %dx%d do not fit in the ring buffer." % (name, image.shape[1], image.shape[0]))
+					sys.exit(EXIT_FATAL)
+				shape = image.shape[:2]
+				view = ring.image(slot, *shape)
+				np.copyto(view, image)
+			frame_index += 1
+			timestamp = media_timestamp(videoStream, frame_index, stream_start, fps) if offline else datetime.datetime.now()
+
+			moving = True
+			motion_seconds = 0.0
+			if motion_gate is not None:
+				start = time.perf_counter()
+				moving = motion_gate.moving(view)
+				motion_seconds = time.perf_counter() - start
+
+			# Without a live camera to keep up with, the previous frame has to be taken before a new one is published.
+			while offline and ring.pending() > 0 and not stop.is_set():
+				ring.beat()
+				stop.wait(0.005)
+			ring.publish(slot, frame_index, shape[0], shape[1], timestamp.timestamp(), moving, read_seconds, motion_seconds)
+			ready.set()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		videoStream.release()
+		ring.close()
+
+
+class CameraReporters(object):
+	"""
+	This class saves the records of each camera to its own CSV files or database, through a single ReporterSink.
+	"""
+	def __init__(self, reporters):
+		self.reporters = reporters
+
+
+	def data_save(self, record):
+		self.reporters[record["camera"]].data_save(record)
+
+
+	def close(self):
+		for reporter in self.reporters.values():
+			reporter.close()
+
+
+def create_reporter(config, name):
+	"""
+	Instantiates the reporter of a camera. The name of the camera is added to the files it writes.
+	"""
+	if config["result"]["backend"] == "sqlite":
+		root, extension = os.path.splitext(config["result"]["database"])
+		return DatabaseReporter(root + "-" + name + extension, config["result"]["buffer_size"], config["result"]["flush_interval"], config["result"]["fsync"])
+	return Reporter(config["result"]["logs"] + name + "-", config["result"]["buffer_size"], config["result"]["flush_interval"], config["result"]["fsync"],
+		config["result"]["rotate_size"] * 1024 * 1024, config["result"]["rotate_daily"])
+
+
+class Camera(object):
+	"""
+	This class keeps what the supervisor needs for each camera: its ring buffer and decode worker, and its own
+	view of the shared detector, tracker, counter and metrics.
+	"""
+	def __init__(self, name, config, model, ring, metrics):
+		self.name = name
+		self.config = config
+		self.ring = ring
+		self.metrics = metrics
+		self.detector = limit_to_regions(model, config)
+		tracker_backend = BatchSort if config["tracker"]["backend"] == "batch" else Sort
+		self.tracker = tracker_backend(max_age = config["tracker"]["max_age"], min_hits = config["tracker"]["min_hits"], iou_threshold = config["tracker"]["iou_threshold"])
+		self.counter = ObjectCounter(None, config["tracker"]["history"], create_calibration(config))
+		self.checkpoint = create_checkpoint(config) if not config["input"]["offline"] else None
+		if self.checkpoint is not None:
+			self.checkpoint.load(self.tracker, self.counter)
+		self.process = None
+		self.restarts = 0
+		self.restart_at = 0.0
+		self.delay = 0.0
+		self.frames_since_start = 0
+		self.finished = False
+
+
+class Supervisor(object):
+	"""
+	This class runs a decode worker process per camera and processes the frames of all of them with a single model.
+	The frames are passed through shared memory ring buffers, so they are never pickled. Workers that crash, lose
+	their stream or stop sending frames are started again, waiting longer after each failed attempt. The records of
+	all the cameras go to the same outputs, and their metrics are served together, labelled by camera.
+	"""
+	def __init__(self, config):
+		self.config = config
+		settings = config["supervisor"]
+		# The writer needs a slot that is neither being read nor the newest one.
+		self.slots = max(3, settings["slots"])
+		self.max_width = settings["max_width"]
+		self.max_height = settings["max_height"]
+		self.restart_delay = settings["restart_delay"]
+		self.restart_max_delay = settings["restart_max_delay"]
+		self.stall_timeout = settings["stall_timeout"]
+
+		# The workers are spawned, not forked, so they do not inherit the loaded model or the threads of the supervisor.
+		self.context = multiprocessing.get_context("spawn")
+		self.ready = self.context.Event()
+		self.stop_event = self.context.Event()
+
+		# The model is loaded once, and shared by all the cameras, each one limited to its own regions.
+		self.model = load_detector(config)
+
+		self.metrics = Metrics()
+		self.cameras = []
+		for i, camera in enumerate(settings["cameras"]):
+			config = camera_config(self.config, camera)
+			ring = FrameRing("otd-%d-%d" % (os.getpid(), i), self.context.Lock(), self.slots, self.max_width, self.max_height, create = True)
+			metrics = Metrics(labels = {"camera": camera["name"]})
+			for name in ("frames_dropped", "frames_static", "worker_restarts"):
+				metrics.increment(name, 0)
+			self.cameras.append(Camera(camera["name"], config, self.model, ring, metrics))
+
+		# The records of all the cameras are handed to the same outputs.
+		self.reporters = CameraReporters({camera.name: create_reporter(self.config, camera.name) for camera in self.cameras})
+		self.client = MqttClient(self.config["mqtt"]["broker"], self.config["mqtt"]["port"], qos = self.config["mqtt"]["qos"],
+			batch_size = self.config["mqtt"]["batch_size"], batch_interval = self.config["mqtt"]["batch_interval"], spool_path = self.config["mqtt"]["spool"],
+			spool_size = self.config["mqtt"]["spool_size"], verbose = self.config["result"]["verbose"])
+		self.bus = EventBus()
+		self.bus.add_sink(ReporterSink(self.reporters, self.config["events"]["queue_size"], self.config["events"]["report_policy"]))
+		self.bus.add_sink(MqttSink(self.client, self.config["mqtt"]["topic"], self.config["events"]["queue_size"], self.config["events"]["mqtt_policy"]))
+		if self.config["events"]["webhook_url"]:
+			self.bus.add_sink(WebhookSink(self.config["events"]["webhook_url"], self.config["events"]["webhook_timeout"], self.config["events"]["queue_size"],
+				self.config["events"]["webhook_policy"]))
+
+		self.metrics_server = None
+		if self.config["metrics"]["enabled"]:
+			self.metrics_server = MetricsServer(MetricsGroup([self.metrics] + [camera.metrics for camera in self.cameras]),
+				self.config["metrics"]["host"], self.config["metrics"]["port"])
+
+
+	def start_worker(self, camera):
+		"""
+		Starts the decode worker of a camera.
+		"""
+		camera.ring.reset()
+		camera.process = self.context.Process(target = decode_worker, name = "decode-" + camera.name, daemon = True,
+			args = (camera.name, camera.config, camera.ring.name, camera.ring.lock, self.slots, self.max_width, self.max_height, self.ready, self.stop_event))
+		camera.process.start()
+		camera.frames_since_start = 0
+
+
+	def check_workers(self):
+		"""
+		Starts again the workers that exited or stopped sending frames, after a delay that doubles each time
+		they fail without sending a frame. Returns False once every camera has finished.
+		"""
+		now = time.monotonic()
+		for camera in self.cameras:
+			if camera.finished:
+				continue
+			process = camera.process
+			if process is not None and process.is_alive():
+				if now - camera.ring.heartbeat() < self.stall_timeout:
+					continue
+				print("[WARNING] %s: No frames for %d s, the worker is stopped." % (camera.name, self.stall_timeout))
+				process.kill()
+				process.join()
+
+			if process is not None:
+				# The frames still in the ring are processed before the worker is replaced.
+				if camera.ring.pending() > 0:
+					continue
+				camera.process = None
+				if process.exitcode == EXIT_ENDED and camera.ring.ended():
+					print("[INFO]    %s: The video has ended." % (camera.name))
+					for record in camera.counter.drain():
+						record["camera"] = camera.name
+						self.bus.publish(record)
+					camera.finished = True
+					continue
+				if process.exitcode == EXIT_FATAL:
+					print("[ERROR]   %s: The worker cannot work with this camera, it is not started again." % (camera.name))
+					camera.finished = True
+					continue
+				# The delay is only reset if the worker managed to send frames.
+				camera.delay = self.restart_delay if camera.frames_since_start > 0 else min(max(camera.delay * 2, self.restart_delay), self.restart_max_delay)
+				camera.restart_at = now + camera.delay
+				camera.restarts += 1
+				camera.metrics.increment("worker_restarts")
+				print("[WARNING] %s: The worker exited with code %s, starting it again in %.1f s." % (camera.name, process.exitcode, camera.delay))
+
+			if camera.process is None and now >= camera.restart_at:
+				self.start_worker(camera)
+		return not all(camera.finished for camera in self.cameras)
+
+
+	def process(self, camera, frame):
+		"""
+		Detects, tracks and counts the vehicles of a frame of a camera, and hands the finished records to the outputs.
+		"""
+		index, image, timestamp, captured, moving, read_seconds, motion_seconds, skipped = frame
+		metrics = camera.metrics
+		metrics.observe("read", read_seconds)
+		metrics.observe("motion", motion_seconds)
+		metrics.increment("frames_dropped", skipped)
+		camera.frames_since_start += 1
+
+		# The frame is read straight from the shared memory, it is not copied.
+		if moving:
+			detections = camera.detector.detect(image)
+			for stage, seconds in camera.detector.timings.items():
+				metrics.observe(stage, seconds)
+			detections = detections[np.isin(detections[:, 5], camera.config["detector"]["classes"])]
+		else:
+			detections = np.empty((0, 6))
+			metrics.increment("frames_static")
+
+		start = time.perf_counter()
+		trackers = camera.tracker.update(detections)
+		tracked = time.perf_counter()
+		metrics.observe("tracker", tracked - start)
+
+		# The counter messages of several cameras would be mixed up, so a line per record is shown instead.
+		with contextlib.redirect_stdout(self.devnull):
+			records = camera.counter.update(trackers, False, index, datetime.datetime.fromtimestamp(timestamp))
+		metrics.observe("counter", time.perf_counter() - tracked)
+		for record in records:
+			record["camera"] = camera.name
+			self.bus.publish(record)
+			print("[INFO]    %s: Vehicle %d, class %d, direction %d, %.2f km/h." % (camera.name, record["id"], record["class"], record["direction"], record["speed"]))
+
+		metrics.frame_done()
+		self.metrics.frame_done()
+		metrics.set("pipeline_lag_seconds", time.monotonic() - captured)
+		metrics.set("objects_tracked", len(camera.counter.objects))
+		if camera.checkpoint is not None and camera.checkpoint.due():
+			camera.checkpoint.save(camera.tracker, camera.counter)
+
+
+	def run(self):
+		"""
+		Processes the frames of all the cameras until every stream ends or a SIGINT is received.
+		"""
+		print("[INFO]    Supervising %d cameras: %s" % (len(self.cameras), ", ".join(camera.name for camera in self.cameras)))
+		last_check = 0.0
+		with open(os.devnull, "w") as self.devnull:
+			while True:
+				if time.monotonic() - last_check >= poll_interval:
+					if not self.check_workers():
+						break
+					last_check = time.monotonic()
+					self.metrics.sinks = self.bus.stats()
+
+				# The flag is cleared before looking at the rings, so a frame published meanwhile is not missed.
+				self.ready.clear()
+				processed = False
+				for camera in self.cameras:
+					frame = camera.ring.take()
+					if frame is not None:
+						self.process(camera, frame)
+						processed = True
+				if not processed:
+					self.ready.wait(poll_interval)
+
+
+	def stop(self):
+		"""
+		Stops the workers, saves the checkpoints and closes the outputs and the shared memory.
+		"""
+		self.stop_event.set()
+		for camera in self.cameras:
+			if camera.process is not None:
+				camera.process.join(5)
+				if camera.process.is_alive():
+					camera.process.kill()
+					camera.process.join()
+			if camera.checkpoint is not None:
+				try:
+					camera.checkpoint.save(camera.tracker, camera.counter, clean = True)
+				except Exception as e:
+					print("[ERROR]   %s: Could not save the checkpoint: %s" % (camera.name, e))
+			camera.ring.close()
+		self.bus.close()
+		self.reporters.close()
+		self.client.disconnect()
+		if self.metrics_server is not None:
+			self.metrics_server.stop()
@@ -23,15 +23,18 @@ import datetime
 import numpy as np
 
 from utils.utils import calculate_centroid
-from obj.obj import ObjectToTrack
+from obj.obj import ObjectToTrack, FRAME, TIME, X, Y, GROUND_X, GROUND_Y, default_capacity
+from calibration.calibration import Calibration, default_image_points, default_world_points, default_lines
 
 class ObjectCounter(object):
 	"""
 	This class is used to keep track and count all the previously identified objects.
 	"""
 
-	def __init__(self, videoStream):
-		self.objects = []
+	def __init__(self, videoStream, history = default_capacity, calibration = None):
+		self.objects = {}
+		self.history = history
+		self.calibration = calibration if calibration is not None else Calibration(default_image_points, default_world_points, default_lines)
 		self.object_count = 0
 		self.objects_one_way = 0
 		self.objects_other_way = 0
@@ -43,104 +46,137 @@ class ObjectCounter(object):
 
 	def check_object_counted(self, objectId):
 		"""
-		Takes and object ID and returns its position if positive.
+		Takes and object ID and returns the object if it is already tracked.
 		"""
-		for obj in self.objects:
-			if obj.id == objectId:
-				return obj
-		return None
+		return self.objects.get(objectId)
 	
 
 	def append_object(self, newObject):
 		"""
-		Just appends new objects to the objects array.
+		Just adds new objects to the tracked objects, indexed by their ID.
 		"""
 		newObject.counted = True
 		newObject.frames_seen += 1
-		self.objects.append(newObject)
+		self.objects[newObject.id] = newObject
 		self.object_count += 1
 	
 
 	def update_all_frames(self):
 		"""
-		Updates the frame counter of each one of the tracked objects.
+		Updates the frame counter of each one of the tracked objects that was not seen in the current frame.
 		"""
-		if self.objects:
-			for obj in self.objects:
+		for obj in self.objects.values():
+			if obj.frame_last_seen != self.current_frame:
 				obj.frames_since_seen += 1
 
 
-	def delete_object(self, index):
+	def delete_object(self, objectId):
 		"""
-		Removes an object from the tracked object array.
+		Removes an object from the tracked objects.
 		"""
-		self.objects.pop(index)
+		del self.objects[objectId]
 		self.object_count -= 1
 	
 
-	def save_object(self, index):
+	def save_object(self, objectId):
 		"""
-		Stores all the object information into a dictionary for later processing.
+		Stores all the object information into a dictionary for later processing. The values keep their types,
+		each output formats them as it needs. A speed of -1 means it could not be measured.
 		"""
-		if(self.objects[index].speed > 0):
-			y = {
-				"id": str(self.objects[index].id), 
-				"position": str(self.objects[index].positions[-1]),
-				"timestamp": str(self.objects[index].timestamps[-1].strftime('%d/%m/%Y %H:%M:%S')),
-				"direction": str(self.objects[index].direction),
-				"speed": str(self.objects[index].speed),
-				"class": str(self.objects[index].object_class)
-				}
-			self.to_save.append(y)
+		obj = self.objects[objectId]
+		y = {
+			"id": int(obj.id), 
+			"position": obj.last_position(),
+			"timestamp": obj.last_timestamp,
+			"direction": int(obj.direction),
+			"speed": float(obj.speed),
+			"class": int(obj.object_class)
+			}
+		self.to_save.append(y)
+		obj.reported = True
+
+
+	def measure_speed(self, obj, crossed):
+		"""
+		Returns the speed in km/h between the first and the last of the given reference lines, from the interpolated
+		times at which they were crossed, or -1 if it cannot be calculated. The lines are already in metres along the road.
+		"""
+		if len(crossed) < 2:
+			return -1
+		distance_diff = abs(self.calibration.lines[crossed[-1]] - self.calibration.lines[crossed[0]])
+		time_diff = abs(obj.crossings[crossed[-1]] - obj.crossings[crossed[0]])
+		if time_diff > 0:
+			return round((distance_diff / time_diff) * 3.6, 2) # m/s to km/h conversion.
+		return -1
+
+
+	def finish_object(self, objectId):
+		"""
+		Reports an object that is no longer followed and was not reported yet. Its speed is measured from the lines
+		it did cross, as it may have been first seen past some of them, for example under a new ID after an occlusion.
+		"""
+		obj = self.objects[objectId]
+		if obj.reported:
+			return
+		if obj.speed == 0:
+			obj.speed = self.measure_speed(obj, obj.crossed_lines())
+		self.save_object(objectId)
 	
 
-	def update(self, tracked_objects, verbose):
+	def update(self, tracked_objects, verbose, frame_number = None, timestamp = None):
 		"""
-		Updates the status of all the tracked objects along with all their parameters.
+		Updates the status of all the tracked objects along with all their parameters. Returns the records of the objects that finished.
+		The frame number must be given when the frames are decoded ahead on another thread.
+		The timestamp of the frame can be taken from the stream's clock; otherwise the wall clock is used.
 		"""
 		# Get the current frame number.
-		self.current_frame = self.video.get(cv2.CAP_PROP_POS_FRAMES)
+		if frame_number is None:
+			self.current_frame = self.video.get(cv2.CAP_PROP_POS_FRAMES)
+		else:
+			self.current_frame = frame_number
+
+		# Get the time the frame was captured.
+		if timestamp is None:
+			timestamp = datetime.datetime.now()
 		
 		# Check if the object is already tracked or not.
 		if tracked_objects.size != 0:
-			for obj in tracked_objects:
+			# The ground point of every track, the middle of the bottom edge of its box, is converted to metres at once.
+			ground_positions = self.calibration.to_world(np.stack(((tracked_objects[:, 0] + tracked_objects[:, 2]) / 2, tracked_objects[:, 3]), axis = 1))
+			for obj, ground_position in zip(tracked_objects, ground_positions):
 				tracked_id = int(obj[4])
 				object_class = int(obj[5])
 				# Calculate the centroid.
 				new_position = calculate_centroid(obj[0], obj[1], obj[2], obj[3])
 				# Check if it is counted.
 				search_result = self.check_object_counted(tracked_id)
-				# If not, it is added to the tracked object array.
+				# If not, it is added to the tracked objects.
 				if search_result is None:
-					new_car = ObjectToTrack(tracked_id, object_class, new_position, self.current_frame, datetime.datetime.now())
+					new_car = ObjectToTrack(tracked_id, object_class, new_position, ground_position, self.current_frame, timestamp,
+						self.calibration.lines, self.history)
 					self.append_object(new_car)
 				else:
 					# If it is counted, then all its parameters are updated.
-					for obje in self.objects:
-						if obje.id == search_result.id:
-							obje.add_position(new_position, self.current_frame)
-						else:
-							if obje.frame_last_seen != self.current_frame:
-								obje.frames_since_seen += 1
+					search_result.add_position(new_position, ground_position, self.current_frame, timestamp)
 		
-		# If no objects where retrieved from the tracker, the frame counter for all the objects is updated.
-		else:
-			self.update_all_frames()
-
-		# And since this function has to run frequently, the status of all the objects is updated.
-		for obj in self.objects:
-			# Check if there are objects to be deleted.
-			if obj.frames_since_seen > self.max_unwatch_frames:
-				self.save_object(self.objects.index(obj))
-				self.delete_object(self.objects.index(obj))
+		# The frame counter of all the objects that were not retrieved from the tracker is updated at once.
+		self.update_all_frames()
+
+		# Objects that have not been seen for a while are saved and deleted. The IDs are collected first,
+		# so the dictionary is not modified while it is being iterated.
+		lost_ids = [obj.id for obj in self.objects.values() if obj.frames_since_seen > self.max_unwatch_frames]
+		for lost_id in lost_ids:
+			# Objects already reported when they crossed the last line are not reported again.
+			self.finish_object(lost_id)
+			self.delete_object(lost_id)
+
+		# And since this function has to run frequently, the status of all the remaining objects is updated.
+		for obj in self.objects.values():
 			# Check if direction can be calculated.
 			if obj.frames_seen > 5 and obj.direction == 0:
 				print("[INFO]    Object class:", obj.object_class)
-				# An auxiliary array to store all the centroids.
-				x = []
-				for p in obj.positions:
-					x.append(p[0])
-				if (int(obj.last_position()[0]) - int(np.mean(x))) > 0:
+				# The mean of the centroids kept in the trajectory.
+				if (int(obj.last_position()[0]) - int(np.mean(obj.trajectory()[:, X]))) > 0:
 					# Left to right direction.
 					obj.direction = 1
 					self.objects_one_way += 1
@@ -151,67 +187,102 @@ class ObjectCounter(object):
 					self.objects_other_way += 1
 					print("[INFO]    Direction: <-----")
 			
-			# If the direction could be calculated, then speed can also be determined based on position and time references.
-			if obj.direction == 1:
-				if obj.last_position()[0] > 850:
-					if not(obj.speed_ready):
-						obj.find_references()
-						if verbose:
-							print("[DEBUG]   Point A:", obj.pixel_ref["A"], ", Timestamp:", obj.time_ref["A"])
-							print("[DEBUG]   Point B:", obj.pixel_ref["B"], ", Timestamp:", obj.time_ref["B"])
-							print("[DEBUG]   Point C:", obj.pixel_ref["C"], ", Timestamp:", obj.time_ref["C"])
-							print("[DEBUG]   Point D:", obj.pixel_ref["D"], ", Timestamp:", obj.time_ref["D"])
-						obj.speed_ready = True
-
-			elif obj.direction == 2:
-				if obj.last_position()[0] < 530:
-					if not(obj.speed_ready):
-						obj.find_references()
-						if verbose:
-							print("[DEBUG]   Point A:", obj.pixel_ref["A"], ", Timestamp:", obj.time_ref["A"])
-							print("[DEBUG]   Point B:", obj.pixel_ref["B"], ", Timestamp:", obj.time_ref["B"])
-							print("[DEBUG]   Point C:", obj.pixel_ref["C"], ", Timestamp:", obj.time_ref["C"])
-							print("[DEBUG]   Point D:", obj.pixel_ref["D"], ", Timestamp:", obj.time_ref["D"])
-
-						obj.speed_ready = True
-
-			# And calculate the speed using the found references.
-			if obj.speed_ready and obj.speed == 0:
-				calculated_speed = []
-				i = "A"
-				j = chr(ord(i) + 1)
-				if obj.direction == 2:
-					while j != "E":
-						distance_diff = (obj.pixel_ref[i] - obj.pixel_ref[j]) * 0.0087 # Meters by pixel.
-						time_diff = abs(obj.time_ref[j].timestamp() - obj.time_ref[i].timestamp())
-						try:
-							velocity = (distance_diff / time_diff) * 3.6 # m/s to km/h conversion.
-							calculated_speed.append(round(velocity, 2))
-						except ZeroDivisionError:
-							calculated_speed.append(-1) # Speed could not be calculated.
-						i = chr(ord(i) + 1)
-						j = chr(ord(j) + 1)
-				elif obj.direction == 1:
-					while j != "E":
-						distance_diff = (obj.pixel_ref[i] - obj.pixel_ref[j]) * 0.0087 # Meters by pixel.
-						time_diff = abs(obj.time_ref[i].timestamp() - obj.time_ref[j].timestamp())
-						try:
-							velocity = (distance_diff / time_diff) * 3.6 # m/s to km/h conversion.
-							calculated_speed.append(round(velocity, 2))
-						except ZeroDivisionError:
-							calculated_speed.append(-1) # Speed could not be calculated.
-						i = chr(ord(i) + 1)
-						j = chr(ord(j) + 1)
+			# The speed is calculated as soon as the object crosses the last reference line, from the interpolated times
+			# at which it crossed the first and the last one. The lines are already in metres along the road.
+			if obj.speed == 0 and obj.crossed_all_lines():
 				if verbose:
+					# The speed between each pair of lines, to see how steady it was.
+					calculated_speed = []
+					lines = self.calibration.lines
+					for i in range(len(lines) - 1):
+						distance_diff = lines[i + 1] - lines[i]
+						time_diff = abs(obj.crossings[i + 1] - obj.crossings[i])
+						calculated_speed.append(round(distance_diff / time_diff * 3.6, 2) if time_diff > 0 else -1)
+					for line, crossing in zip(lines, obj.crossings):
+						print("[DEBUG]   Line:", line, ", Crossed at:", crossing)
 					print("[DEBUG]   Estimated speed:", calculated_speed)
-				obj.speed = round(np.average(calculated_speed), 2)
+
+				obj.speed = self.measure_speed(obj, range(len(self.calibration.lines)))
 				print("[INFO]    Speed:", obj.speed, "km/h")
 				
 				# And show the object count.
 				print("[INFO]    Counted objects:", self.object_count)
+
+			# The object is reported right away, once its speed and direction are known, without waiting for it to leave.
+			if not obj.reported and obj.speed != 0 and obj.direction != 0:
+				self.save_object(obj.id)
 		
-		# If there are objects to store, then return them.
-		if self.to_save:
-			return(self.to_save.pop())
-		else:
-			return(None)
\ No newline at end of file
+		# All the objects that finished in this frame are returned, as a list that can be empty.
+		finished, self.to_save = self.to_save, []
+		return finished
+
+
+	def drain(self):
+		"""
+		Returns the records of the objects still tracked that were not reported yet, for example at the end of a video.
+		"""
+		for object_id in list(self.objects):
+			self.finish_object(object_id)
+		finished, self.to_save = self.to_save, []
+		return finished
+
+
+	def state(self):
+		"""
+		Returns a snapshot of the counter and of the objects being tracked as a dictionary of arrays. The trajectories
+		of all the objects are stored one after the other, oldest row first, with the number of rows of each object.
+		"""
+		objects = list(self.objects.values())
+		lines = len(self.calibration.lines)
+		return {
+			"counts": np.array([self.objects_one_way, self.objects_other_way]),
+			"lines": np.array(self.calibration.lines, dtype=float),
+			"ids": np.array([obj.id for obj in objects], dtype=int),
+			"fields": np.array([[obj.object_class, obj.frames_since_seen, obj.frames_seen, obj.frame_last_seen, obj.counted, obj.direction,
+				obj.speed, obj.reported] for obj in objects], dtype=float).reshape(len(objects), 8),
+			"crossings": np.array([[np.nan if c is None else c for c in obj.crossings] for obj in objects], dtype=float).reshape(len(objects), lines),
+			"crossing_directions": np.array([obj.crossing_directions for obj in objects], dtype=int).reshape(len(objects), lines),
+			"sizes": np.array([obj.size for obj in objects], dtype=int),
+			"tracks": np.concatenate([np.roll(obj.track, -obj.head, axis = 0)[-obj.size:] for obj in objects]) if objects else np.empty((0, 6)),
+		}
+
+
+	def restore(self, state, objects = True):
+		"""
+		Loads a snapshot taken by state(). The objects are only restored if they were tracked with the same reference
+		lines; otherwise, or if objects is False, just the counts are.
+		"""
+		self.objects_one_way, self.objects_other_way = (int(c) for c in state["counts"])
+		self.objects = {}
+		self.object_count = 0
+		if not objects:
+			return
+		if not np.array_equal(state["lines"], np.asarray(self.calibration.lines, dtype=float)):
+			print("[WARNING] The reference lines changed, the objects of the checkpoint are not restored.")
+			return
+
+		start = 0
+		for i, object_id in enumerate(state["ids"]):
+			# Only the newest rows are kept if the history is now shorter.
+			rows = state["tracks"][start:start + state["sizes"][i]][-self.history:]
+			start += state["sizes"][i]
+			object_class, frames_since_seen, frames_seen, frame_last_seen, counted, direction, speed, reported = state["fields"][i]
+			first = rows[0]
+			obj = ObjectToTrack(int(object_id), int(object_class), (first[X], first[Y]), (first[GROUND_X], first[GROUND_Y]), first[FRAME],
+				datetime.datetime.fromtimestamp(first[TIME]), self.calibration.lines, self.history)
+			# The whole trajectory is copied at once, without checking the crossings again.
+			obj.track[:len(rows)] = rows
+			obj.size = len(rows)
+			obj.head = len(rows) % len(obj.track)
+			obj.last_timestamp = datetime.datetime.fromtimestamp(rows[-1][TIME])
+			obj.crossings = [None if np.isnan(c) else float(c) for c in state["crossings"][i]]
+			obj.crossing_directions = [int(d) for d in state["crossing_directions"][i]]
+			obj.frames_since_seen = int(frames_since_seen)
+			obj.frames_seen = int(frames_seen)
+			obj.frame_last_seen = int(frame_last_seen)
+			obj.counted = bool(counted)
+			obj.direction = int(direction)
+			obj.speed = float(speed)
+			obj.reported = bool(reported)
+			self.objects[obj.id] = obj
+		self.object_count = len(self.objects)
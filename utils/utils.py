@@ -16,9 +16,25 @@
 	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import numpy as np
+import datetime
+import re
 import cv2
 
+def read_label_file(path):
+	"""
+	Reads a labels file with an "ID label" pair per line into a dictionary. Lines without an ID are numbered in order.
+	"""
+	labels = {}
+	with open(path, 'r', encoding = 'utf-8') as f:
+		for row, line in enumerate(f.readlines()):
+			pair = re.split(r'[:\s]+', line.strip(), maxsplit = 1)
+			if len(pair) == 2 and pair[0].strip().isdigit():
+				labels[int(pair[0])] = pair[1].strip()
+			else:
+				labels[row] = pair[0].strip()
+	return labels
+
+
 def calculate_centroid(x1, y1, x2, y2):
 	"""
 	Calculates the centroid of a rectangle based on two corners coordinates.
@@ -26,24 +42,54 @@ def calculate_centroid(x1, y1, x2, y2):
 	return(int((x1 + x2)/2), int((y1 + y2)/2))
 
 
-def find_nearest(array, value):
+def open_stream(source, width = 0, height = 0):
+	"""
+	Opens a video stream. If a width and height are given, the decoder is asked for frames of that size,
+	so smaller frames are decoded and copied. Cameras usually honour it, video files do not.
+	"""
+	video_stream = cv2.VideoCapture(source)
+	if width and height:
+		video_stream.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+		video_stream.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+		actual = (int(video_stream.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video_stream.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+		if actual != (width, height):
+			print("[WARNING] The video stream does not support a resolution of %dx%d, using %dx%d." % (width, height, actual[0], actual[1]))
+	return video_stream
+
+
+def media_timestamp(video_stream, frame_index, start, fps):
+	"""
+	Returns the time of the last decoded frame according to the stream's own clock, relative to the start time.
+	If the stream has no timestamps, the frame index and the frame rate are used instead.
+	"""
+	msec = video_stream.get(cv2.CAP_PROP_POS_MSEC)
+	if msec <= 0 and fps > 0:
+		msec = (frame_index - 1) * 1000.0 / fps
+	return start + datetime.timedelta(milliseconds = msec)
+
+
+def draw_objects(img, detections, labels):
 	"""
-	Find the nearest array object for a certain value.
+	Draws a bounding box and label for each object. Each detection is a [x1, y1, x2, y2, score, class] row.
 	"""
-	array = np.asarray(array)
-	id_x = (np.abs(array - value)).argmin()
-	return id_x
+	for detection in detections:
+		xmin, ymin, xmax, ymax = (int(value) for value in detection[:4])
+		score = detection[4]
+		class_id = int(detection[5])
+		if class_id == 2 or class_id == 3 or class_id == 7:
+			label = str(labels.get(class_id, class_id))
+			cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 255, 0), 1)
+			(label_width, label_height), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+			cv2.rectangle(img, (xmin, ymin), (xmin + label_width + 20, ymin + 4*label_height), (0, 255, 0), -1)
+			cv2.putText(img, '%s' % (label.capitalize()), (xmin + 10, ymin + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+			cv2.putText(img, '%.2f' % (score), (xmin + 10, ymin + 40), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
 
 
-def draw_objects(img, objs, labels):
+def draw_tracks(img, tracks):
 	"""
-	Draws a bounding box and label for each object.
+	Draws the box and the ID of each track. Each track is a [x1, y1, x2, y2, id, ...] row.
 	"""
-	for obj in objs:
-		if obj.id == 2 or obj.id == 3 or obj.id == 7:
-			bbox = obj.bbox
-			cv2.rectangle(img, (bbox.xmin, bbox.ymin), (bbox.xmax, bbox.ymax), (0, 255, 0), 1)
-			(label_width, label_height), baseline = cv2.getTextSize(labels.get(obj.id, obj.id), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
-			cv2.rectangle(img, (bbox.xmin, bbox.ymin), (bbox.xmin + label_width + 20, bbox.ymin + 4*label_height), (0, 255, 0), -1)
-			cv2.putText(img, '%s' % (labels.get(obj.id, obj.id).capitalize()), (bbox.xmin + 10, bbox.ymin + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
-			cv2.putText(img, '%.2f' % (obj.score), (bbox.xmin + 10, bbox.ymin + 40), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
\ No newline at end of file
+	for track in tracks:
+		xmin, ymin, xmax, ymax = (int(value) for value in track[:4])
+		cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 255, 255), 1)
+		cv2.putText(img, '%d' % (track[4]), (xmin, ymax + 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1, cv2.LINE_AA)